@@ -1,31 +1,22 @@
 import numpy as np
 from Utilities.Tropical_Helper_Functions import compute_maximal_difference, evaluate_tropical_function, get_current_data,\
     get_last_layer_index, get_tropical_function_directory, get_tropical_test_labels, load_tropical_function, \
-    get_no_labels, get_epoch_numbers, get_max_data_group_size, evaluate_network_on_subgrouped_data, get_folder_name, \
-    get_batch_data
+    get_epoch_numbers, evaluate_network_on_subgrouped_data, get_folder_name, \
+    get_batch_data, get_data_points, get_mips_index, get_term_buckets, prepare_data_for_tropical_function
 from Utilities.Custom_Settings import apply_resnet_settings, configure_gpu
+from Utilities.Epoch_Scheduler import run_epochs
 from Utilities.Logger import *
+from Utilities.MIPS_Index import MAX_PROBE_FRACTION
 from Utilities.Network_Loader import load_network
 from Utilities.Parser import parse_arguments
 from Utilities.Saver import get_saving_directory
 
-start_time = print_start()
-
-# To raise an exception on runtime warnings, used for debugging.
-np.seterr(all='raise')
-
-# Load the arguments
-arg = parse_arguments()
-if arg.network_type_coarse == 'ResNet':
-    arg = apply_resnet_settings(arg)
-
-# Configure the GPU for Tensorflow
-configure_gpu(arg)
-
-
 # COMPUTATION OF ACCURACY OF TROPICAL FUNCTION
-def evaluate_x_test(arg, layer_idx):
-    grouped_data, true_labels, network_labels = get_batch_data(arg, network)
+def evaluate_x_test(arg, network, epoch_number, data_points, logger, layer_idx):
+    grouped_data, true_labels, network_labels = get_batch_data(arg, network, data_points=data_points)
+    true_labels = np.concatenate(true_labels)
+    network_labels = np.concatenate(network_labels)
+    last_layer_index = get_last_layer_index(network)
     if layer_idx == 'all':
         lower_idx = 0
         upper_idx = last_layer_index + 1
@@ -34,7 +25,25 @@ def evaluate_x_test(arg, layer_idx):
         upper_idx = layer_idx + 1
     accuracies = []
     for i in range(lower_idx, upper_idx):
-        tropical_test_labels = get_tropical_test_labels(arg, network, grouped_data, i, epoch_number)
+        folder_name = get_folder_name(network, i)
+        terms, _, training_network_labels = load_tropical_function(arg, folder_name, 'training', epoch_number,
+                                                                   lazy=True)
+        mips_index = None
+        if arg.approximate_search:
+            calibration_data = prepare_data_for_tropical_function(grouped_data[0])
+            mips_index = get_mips_index(arg, folder_name, epoch_number, terms, calibration_data)
+            if mips_index.probe_fraction > MAX_PROBE_FRACTION:
+                logger.info('Using the exact search, the approximate search would have to probe ' +
+                            '{:.2f}'.format(mips_index.probe_fraction) + ' of the partitions')
+                mips_index = None
+            else:
+                logger.info('Agreement of the approximate and the exact search: ' +
+                            str(mips_index.compute_agreement(terms, calibration_data)))
+        term_buckets = None
+        if mips_index is None:
+            term_buckets = get_term_buckets(arg, folder_name, epoch_number, terms)
+        tropical_test_labels = get_tropical_test_labels(terms, training_network_labels, grouped_data, mips_index,
+                                                        term_buckets)
         if tropical_test_labels is not None:
             tropical_accuracy = sum(tropical_test_labels == true_labels) / len(true_labels)
             tropical_network_agreement = sum(tropical_test_labels == network_labels) / len(network_labels)
@@ -44,20 +53,19 @@ def evaluate_x_test(arg, layer_idx):
             logger.info('Agreement of the tropical function and the true labels on the test set: ' + str(
                 tropical_accuracy))
             accuracies.append(np.array([str(tropical_network_agreement), str(tropical_accuracy)]))
-    accuracies = np.array(accuracies)
-    save_dir = get_saving_directory(arg)
-    np.savetxt(os.path.join(save_dir, "accuracies.csv"), accuracies, delimiter=",", fmt='%s')
+    return np.array(accuracies)
 
 
-def evaluate_x_train(arg, layer_idx):
+def evaluate_x_train(arg, network, epoch_number, data_points, logger, layer_idx):
     def compute_max_error(layer_idx):
         folder_name = get_folder_name(network, layer_idx)
         function_path = get_tropical_function_directory(arg, folder_name, 'training', epoch_number)
         current_layer_name = function_path.split('/')[-2]
         logger.info('After merging with layer ' + current_layer_name + ':')
-        current_data = get_current_data(network, grouped_data, layer_idx)
-        pos_terms, true_labels, network_labels = load_tropical_function(arg, folder_name, arg.data_type, epoch_number, sign='pos')
-        terms, _, _ = load_tropical_function(arg, folder_name, arg.data_type, epoch_number, sign='neg')
+        current_data = get_current_data(grouped_data, layer_idx, network)
+        pos_terms, true_labels, network_labels = load_tropical_function(arg, folder_name, arg.data_type, epoch_number,
+                                                                        sign='pos', lazy=True)
+        terms, _, _ = load_tropical_function(arg, folder_name, arg.data_type, epoch_number, sign='neg', lazy=True)
         pos_result, neg_result = evaluate_tropical_function(current_data, network_labels, pos_terms, terms)
         tropical_labels = np.argmax(pos_result, axis=0)
         results = str(sum(tropical_labels == network_labels) / len(network_labels))
@@ -69,29 +77,68 @@ def evaluate_x_train(arg, layer_idx):
         max_result = max_pos_result - max_neg_result
         logger.info('Maximal Error: ' + str(compute_maximal_difference(x_train_predicted, max_result)))
 
-    grouped_data, true_labels, network_labels = get_batch_data(arg, network)
+    grouped_data, true_labels, network_labels = get_batch_data(arg, network, data_points=data_points)
     x_train_predicted = evaluate_network_on_subgrouped_data(network, grouped_data)
 
     if layer_idx == 'all':
-        for i in range(last_layer_index + 1):
+        for i in range(get_last_layer_index(network) + 1):
             compute_max_error(i)
     else:
         compute_max_error(layer_idx)
 
 
-logger = get_logger(arg)
-epoch_numbers = get_epoch_numbers(arg)
-
-for epoch_number in epoch_numbers:
+def evaluate_epoch(arg, epoch_number, data_points, logger=None):
+    # Without a logger, e.g. in a process of the epoch scheduler, the epoch is logged to its own file. Returns the
+    # accuracies on the test set.
+    own_logger = logger is None
+    if own_logger:
+        logger = get_logger(arg, epoch_number)
     print('Epoch number: ' + str(epoch_number))
     logger.info('Epoch number: ' + str(epoch_number))
     network = load_network(arg, epoch_number)
-    last_layer_index = get_last_layer_index(network)
-    no_labels = get_no_labels(network)
 
+    accuracies = None
     if arg.data_type == 'training':
-        evaluate_x_train(arg, layer_idx=0)
+        evaluate_x_train(arg, network, epoch_number, data_points, logger, layer_idx=0)
     elif arg.data_type == 'test':
-        evaluate_x_test(arg, layer_idx=0)
+        accuracies = evaluate_x_test(arg, network, epoch_number, data_points, logger, layer_idx=0)
+
+    if own_logger:
+        for handler in logger.handlers[:]:
+            handler.close()
+            logger.removeHandler(handler)
+    return accuracies
+
+
+# The processes of the epoch scheduler are spawned and import this module, so the evaluation only runs in the main
+# process.
+if __name__ == '__main__':
+    start_time = print_start()
+
+    # To raise an exception on runtime warnings, used for debugging.
+    np.seterr(all='raise')
+
+    # Load the arguments
+    arg = parse_arguments()
+    if arg.network_type_coarse == 'ResNet':
+        arg = apply_resnet_settings(arg)
+
+    # Configure the GPU for Tensorflow
+    configure_gpu(arg)
+
+    logger = get_logger(arg)
+    epoch_numbers = get_epoch_numbers(arg)
+    # The data set is loaded once for all epochs.
+    data_points = get_data_points(arg)
+
+    if arg.no_epoch_processes > 1 and len(epoch_numbers) > 1:
+        all_accuracies = run_epochs(arg, epoch_numbers, evaluate_epoch, data_points, arg.no_epoch_processes)
+    else:
+        all_accuracies = [evaluate_epoch(arg, epoch_number, data_points, logger=logger) for epoch_number in
+                          epoch_numbers]
+    # As before, accuracies.csv holds the accuracies of the last epoch.
+    if arg.data_type == 'test' and len(all_accuracies) > 0:
+        save_dir = get_saving_directory(arg)
+        np.savetxt(os.path.join(save_dir, "accuracies.csv"), all_accuracies[-1], delimiter=",", fmt='%s')
 
-print_end(start_time)
\ No newline at end of file
+    print_end(start_time)
@@ -2,7 +2,6 @@ import getpass
 from multiprocessing import Manager, Process
 import pickle
 import numpy as np
-from functools import reduce
 from scipy.io import savemat
 from Utilities.Custom_Settings import apply_resnet_settings, configure_gpu
 from Utilities.Tropical_Helper_Functions import evaluate_tropical_function, get_current_data, \
@@ -16,6 +15,7 @@ from Utilities.Data_Loader import load_data
 from Utilities.Logger import *
 from Utilities.Network_Loader import load_network
 from Utilities.Parser import parse_arguments
+from Utilities.Prediction_Cache import predict_network
 from Utilities.Saver import get_saving_directory
 
 start_time = print_start()
@@ -132,7 +132,7 @@ def compare_test_and_training_images(arg, lower_true_label, idx):
                     outputs[i] = np.max(np.dot(training_terms[i], reshaped_test_image), axis=0)
                 image_tropical_label = np.argmax(outputs)
                 training_idx = np.argmax(np.dot(training_terms[image_tropical_label], reshaped_test_image), axis=0)
-                network_labels_train = np.argmax(network.predict(x_train), axis=1)
+                network_labels_train = predict_network(network, x_train)['labels']
                 x_train_grouped = group_points(x_train, network_labels_train)
                 corresponding_training_image = x_train_grouped[image_tropical_label][training_idx:training_idx + 1]
                 if (true_label != image_tropical_label):
@@ -214,7 +214,7 @@ def compute_translation_invariance(shift_type):
         for j in range(6):
             shifted_data = shift_array(stacked_data, shifts[i], shifts[j], shift_type)
             # Computing the accuracy of the network on the shifted data.
-            network_labels_shifted = np.argmax(network.predict(shifted_data), axis=1)
+            network_labels_shifted = predict_network(network, shifted_data)['labels']
             network_accuracy_shifted = sum(network_labels_shifted == true_labels) / len(true_labels)
             exp5_network_remaining_accuracy[i, j] = str(network_accuracy_shifted / network_accuracy)
             exp5_network_same_label[i, j] = str(np.sum(network_labels == network_labels_shifted) / len(network_labels))
@@ -543,9 +543,9 @@ def slide_extracted_function_batchwise_over_image():
 
 def compute_coefficient_statistics(arg):
     pos_training_terms, _, _ = load_tropical_function(arg, folder_name, 'training', epoch_number,
-                                                                            sign='pos')
-    training_terms, true_labels_training, network_labels_training = load_tropical_function(arg, folder_name, 'training', epoch_number, sign='linear')
-    test_terms, true_labels_test, network_labels_test = load_tropical_function(arg, folder_name, 'test', epoch_number, sign='linear')
+                                                                            sign='pos', lazy=True)
+    training_terms, true_labels_training, network_labels_training = load_tropical_function(arg, folder_name, 'training', epoch_number, sign='linear', lazy=True)
+    test_terms, true_labels_test, network_labels_test = load_tropical_function(arg, folder_name, 'test', epoch_number, sign='linear', lazy=True)
 
     arg.data_type = 'test'
     test_data_batches, _, _ = get_batch_data(arg, network)
@@ -566,9 +566,9 @@ def compute_coefficient_statistics(arg):
 
 def compare_linear_functions(arg):
     arg.network_number = network_number
-    terms_0, _, _ = load_tropical_function(arg, folder_name, arg.data_type, epoch_number, sign='linear')
+    terms_0, _, _ = load_tropical_function(arg, folder_name, arg.data_type, epoch_number, sign='linear', lazy=True)
     arg.network_number = network_number_1
-    terms_1, _, _ = load_tropical_function(arg, folder_name, arg.data_type, epoch_number, sign='linear')
+    terms_1, _, _ = load_tropical_function(arg, folder_name, arg.data_type, epoch_number, sign='linear', lazy=True)
     return compute_similarity(terms_0, terms_1, epoch_number)
 
 
@@ -577,9 +577,10 @@ def compare_activation_patterns():
         x_train_associated = [None] * no_labels
         for i in range(no_labels):
             x_train_associated[i] = get_associated_training_points(arg, network, x_test[i], x_train)
-        test_activation_patterns = get_activation_patterns(arg, network, max_data_group_size, grouped_data=x_test)
-        associated_training_activation_patterns = \
-            get_activation_patterns(arg, network, max_data_group_size, grouped_data=x_train_associated)
+        test_activation_patterns = [[get_activation_patterns(arg, network, batch=subgroup) for subgroup in group]
+                                    for group in x_test]
+        associated_training_activation_patterns = [[get_activation_patterns(arg, network, batch=subgroup)
+                                                    for subgroup in group] for group in x_train_associated]
         no_relevant_layers = len(test_activation_patterns[0][0])
         activation_patterns_agreement = [None] * no_relevant_layers
         for k in range(no_relevant_layers):
@@ -587,8 +588,8 @@ def compare_activation_patterns():
             for i in range(no_labels):
                 no_subgroups = len(test_activation_patterns[i])
                 for j in range(no_subgroups):
-                    indices = (test_activation_patterns[i][j][k] == associated_training_activation_patterns[i][j][k])
-                    agreement = np.squeeze(np.apply_over_axes(np.sum, indices, range(1, indices.ndim)))
+                    agreement = test_activation_patterns[i][j].compute_agreement(
+                        associated_training_activation_patterns[i][j], k)
                     activation_patterns_agreement[k].append(agreement)
             activation_patterns_agreement[k] = np.hstack(activation_patterns_agreement[k])
         agreements = {}
@@ -598,8 +599,7 @@ def compare_activation_patterns():
         if compute_activation_patterns_size:
             activation_patterns_size = np.zeros(no_relevant_layers)
             for k in range(no_relevant_layers):
-                current_layer_shape = test_activation_patterns[0][0][k].shape[1:]
-                activation_patterns_size[k] = reduce(lambda x, y: x * y, current_layer_shape)
+                activation_patterns_size[k] = test_activation_patterns[0][0].get_no_units(k)
             return agreements, activation_patterns_size
         return agreements
 
@@ -618,7 +618,7 @@ def compare_activation_patterns():
         for key in Dict.keys():
             print_array(Dict[key])
 
-    max_data_group_size = get_max_data_group_size(arg)
+    max_data_group_size = get_max_data_group_size(arg, network)
     x_train = get_grouped_data(arg, network, max_data_group_size, data_type='training')
     x_train = stack_list_with_subgroups(x_train)
     x_test, true_labels, network_labels = get_grouped_data(arg, network, max_data_group_size=max_data_group_size,
@@ -692,10 +692,11 @@ def interpolation(arg, activation_pattern_changes=True, label_changes=False):
 
     def compute_AP_changes():
         def reshape_activation_patterns(activation_patterns):
+            # The packed patterns of two points agree iff their activation patterns agree.
             reshaped_activation_patterns = []
-            for activation_pattern in activation_patterns:
+            for layer_idx in range(len(activation_patterns)):
                 reshaped_activation_patterns.append(
-                    np.reshape(activation_pattern, [different_im_per_batch, no_steps, -1]))
+                    np.reshape(activation_patterns.get_packed(layer_idx), [different_im_per_batch, no_steps, -1]))
             return reshaped_activation_patterns
 
         activation_patterns = get_activation_patterns(arg, network, batch=modified_capped_image)
@@ -765,7 +766,7 @@ def interpolation(arg, activation_pattern_changes=True, label_changes=False):
             statistics[7 + 11 * j] = np.exp(np.std(np.log(Dict['distances_at_first_AP_changes'])))
             statistics[8 + 11 * j] = np.std(Dict['distances_at_first_AP_changes'])
             statistics[9 + 11 * j] = np.max(Dict['distances_at_first_AP_changes'])
-            accuracy = np.sum(np.argmax(network.predict(images), axis=1) == labels) / labels.size
+            accuracy = np.sum(predict_network(network, images)['labels'] == labels) / labels.size
             statistics[10 + 11 * j] = accuracy
 
         file_name = arg.data_type + '_interpolation.pkl'
@@ -777,7 +778,7 @@ def interpolation(arg, activation_pattern_changes=True, label_changes=False):
 
 def compute_network_accuracies(network, x_train, y_train, x_test, y_test, outputs):
     def compute_accuracy(network, data, true_labels):
-        network_labels = np.argmax(network.predict(data), axis=1)
+        network_labels = predict_network(network, data)['labels']
         accuracy = np.sum(network_labels == true_labels) / true_labels.size
 
     outputs['training'] = compute_accuracy(network, x_train, y_train)
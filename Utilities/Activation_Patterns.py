@@ -0,0 +1,115 @@
+import numpy as np
+from Utilities.Saver import open_atomically
+
+# Number of set bits of every byte.
+POPCOUNT_TABLE = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+
+class Activation_Patterns:
+    # Activation patterns of a batch of data points, one array of shape (no_points, ...) per relevant layer and in the
+    # order in which backpropagate consumes them. Bool patterns are stored with np.packbits, so one bit per unit
+    # instead of one byte, and only unpacked when they are indexed or iterated over. Integer patterns, the positions of
+    # the maxima of max pooling layers, are stored as they are.
+    def __init__(self, patterns=()):
+        self.packed_patterns = []
+        self.shapes = []
+        self.dtypes = []
+        for pattern in patterns:
+            self.append(pattern)
+
+    def append(self, pattern):
+        pattern = np.asarray(pattern)
+        flat_pattern = pattern.reshape([pattern.shape[0], -1])
+        if pattern.dtype == bool:
+            flat_pattern = np.packbits(flat_pattern, axis=1)
+        self.packed_patterns.append(flat_pattern)
+        self.shapes.append(pattern.shape)
+        self.dtypes.append(pattern.dtype)
+
+    def __len__(self):
+        return len(self.packed_patterns)
+
+    def __getitem__(self, layer_idx):
+        shape = self.shapes[layer_idx]
+        if self.dtypes[layer_idx] != bool:
+            return self.packed_patterns[layer_idx].reshape(shape)
+        no_units = int(np.prod(shape[1:]))
+        return np.unpackbits(self.packed_patterns[layer_idx], axis=1, count=no_units).astype(bool).reshape(shape)
+
+    def __iter__(self):
+        for layer_idx in range(len(self)):
+            yield self[layer_idx]
+
+    @property
+    def nbytes(self):
+        return sum(packed_pattern.nbytes for packed_pattern in self.packed_patterns)
+
+    def get_no_units(self, layer_idx):
+        return int(np.prod(self.shapes[layer_idx][1:]))
+
+    def get_packed(self, layer_idx):
+        # (no_points, ceil(no_units / 8))-sized uint8 array for bool patterns, (no_points, no_units)-sized for integer
+        # patterns. Two points have the same pattern iff their rows agree.
+        return self.packed_patterns[layer_idx]
+
+    def select(self, points):
+        # Activation patterns of a subset of the data points.
+        selection = Activation_Patterns()
+        for packed_pattern, shape in zip(self.packed_patterns, self.shapes):
+            selection.packed_patterns.append(packed_pattern[points])
+            selection.shapes.append((selection.packed_patterns[-1].shape[0],) + shape[1:])
+        selection.dtypes = list(self.dtypes)
+        return selection
+
+    def get_linear_regions(self, labels):
+        # Groups the data points by their activation patterns in all layers and their labels. The data points of a
+        # group lie in the same linear region of the network and have the same tropical terms. Returns the first data
+        # point of every group and the group of every data point.
+        keys = [np.ascontiguousarray(packed_pattern).view(np.uint8) for packed_pattern in self.packed_patterns]
+        keys = np.hstack(keys + [np.asarray(labels, dtype='<i8').reshape([-1, 1]).view(np.uint8)])
+        keys = np.ascontiguousarray(keys)
+        keys = keys.view(np.dtype((np.void, keys.shape[1]))).ravel()
+        _, representatives, region_index = np.unique(keys, return_index=True, return_inverse=True)
+        return representatives, region_index.reshape([-1])
+
+    def get_changed_points(self, other):
+        # True for the data points whose activation patterns differ from those in other in any layer, i.e. which lie
+        # in a different linear region.
+        if self.shapes != other.shapes:
+            raise Exception('The activation patterns belong to different data points or networks.')
+        changed = np.zeros(self.shapes[0][0] if len(self) > 0 else 0, dtype=bool)
+        for packed_pattern, other_packed_pattern in zip(self.packed_patterns, other.packed_patterns):
+            changed |= np.any(packed_pattern != other_packed_pattern, axis=1)
+        return changed
+
+    def save(self, path):
+        arrays = {}
+        for layer_idx, (packed_pattern, shape) in enumerate(zip(self.packed_patterns, self.shapes)):
+            arrays['pattern_' + str(layer_idx)] = packed_pattern
+            arrays['shape_' + str(layer_idx)] = np.array(shape, dtype=np.int64)
+            arrays['dtype_' + str(layer_idx)] = np.array(self.dtypes[layer_idx].str)
+        with open_atomically(path) as patterns_file:
+            np.savez(patterns_file, **arrays)
+
+    def compute_hamming_distances(self, other, layer_idx):
+        # Number of units of layer_idx on which the data points of self and other disagree, point by point. The
+        # padding bits of np.packbits are zero in both, so they do not count.
+        if self.dtypes[layer_idx] != bool:
+            return np.sum(self.packed_patterns[layer_idx] != other.packed_patterns[layer_idx], axis=1, dtype=np.int64)
+        differences = np.bitwise_xor(self.packed_patterns[layer_idx], other.packed_patterns[layer_idx])
+        return np.sum(POPCOUNT_TABLE[differences], axis=1, dtype=np.int64)
+
+    def compute_agreement(self, other, layer_idx):
+        # Number of units of layer_idx on which the data points of self and other agree, point by point.
+        return self.get_no_units(layer_idx) - self.compute_hamming_distances(other, layer_idx)
+
+
+def load_activation_patterns(path):
+    # Reader for Activation_Patterns.save.
+    activation_patterns = Activation_Patterns()
+    with np.load(path) as patterns_file:
+        for layer_idx in range(len(patterns_file.files) // 3):
+            activation_patterns.packed_patterns.append(patterns_file['pattern_' + str(layer_idx)])
+            activation_patterns.shapes.append(tuple(int(size) for size in patterns_file['shape_' + str(layer_idx)]))
+            activation_patterns.dtypes.append(np.dtype(str(patterns_file['dtype_' + str(layer_idx)])))
+    return activation_patterns
@@ -0,0 +1,67 @@
+import numpy as np
+
+
+class Concatenated_Terms:
+    # Virtual concatenation of the (memory-mapped) shards of a tropical function along the rows. Column slices are
+    # applied lazily and indexing only reads the selected rows from disk, so the whole function is never held in
+    # memory unless it is converted with np.asarray.
+    ndim = 2
+
+    def __init__(self, shards, columns=slice(None)):
+        self.shards = shards
+        self.columns = columns
+        self.offsets = np.cumsum([0] + [shard.shape[0] for shard in shards])
+        self.no_columns = len(range(shards[0].shape[1])[columns]) if len(shards) > 0 else 0
+
+    @property
+    def shape(self):
+        return int(self.offsets[-1]), self.no_columns
+
+    @property
+    def dtype(self):
+        # Batches that fell back from float32 to float64 are saved in float64.
+        return np.result_type(*[shard.dtype for shard in self.shards])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        result = np.vstack([shard[:, self.columns] for shard in self.shards])
+        if dtype is not None:
+            result = result.astype(dtype)
+        return result
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, columns = key
+        else:
+            rows, columns = key, slice(None)
+        if isinstance(rows, slice) and rows == slice(None):
+            if isinstance(columns, slice):
+                columns = range(self.shards[0].shape[1])[self.columns][columns]
+                return Concatenated_Terms(self.shards, slice(columns.start, columns.stop, columns.step))
+            return np.concatenate([np.asarray(shard[:, self.columns][:, columns]) for shard in self.shards])
+        if isinstance(rows, (int, np.integer)):
+            return self.get_rows(np.array([rows]))[0][columns]
+        if isinstance(rows, slice):
+            rows = np.arange(*rows.indices(len(self)))
+        else:
+            rows = np.asarray(rows)
+            if rows.dtype == bool:
+                rows = np.flatnonzero(rows)
+        return self.get_rows(rows)[:, columns]
+
+    def get_rows(self, rows):
+        shard_indices = np.searchsorted(self.offsets, rows, side='right') - 1
+        result = np.empty((rows.shape[0], self.no_columns), dtype=self.dtype)
+        for shard_idx in np.unique(shard_indices):
+            in_shard = shard_indices == shard_idx
+            result[in_shard] = self.shards[shard_idx][rows[in_shard] - self.offsets[shard_idx], self.columns]
+        return result
+
+    def blocks(self, block_size):
+        # Yields (first row, block of rows) shard by shard, at most block_size rows at a time.
+        for shard_idx, shard in enumerate(self.shards):
+            for lower in range(0, shard.shape[0], block_size):
+                upper = min(lower + block_size, shard.shape[0])
+                yield self.offsets[shard_idx] + lower, np.asarray(shard[lower:upper, self.columns])
@@ -1,4 +1,6 @@
 import numpy as np
+import os
+from Utilities.Saver import get_main_directory, open_atomically
 # from Cleverhans.basic_iterative_method import basic_iterative_method
 # from Cleverhans.fast_gradient_method import fast_gradient_method
 # from Cleverhans.madry_et_al import madry_et_al
@@ -40,64 +42,104 @@ def subtract_pixel_mean(x_train, x_test):
     return x_train, x_test
 
 
-# load train and test dataset
-def load_data(arg, data_type='all'):
+def get_data_cache_path(arg, split, name):
+    # The preprocessed variants of the data sets: the pixel mean is only subtracted for ResNets.
+    variant = arg.data_set.replace(' ', '_')
+    if arg.network_type_coarse == 'ResNet':
+        variant += '_pixel_mean_subtracted'
+    return os.path.join(get_main_directory(), 'Data_Cache', '_'.join([variant, split, name]) + '.npy')
+
+
+def decode_data(arg):
     def scale_pixels(x_train, x_test):
         return x_train.astype('float32') / 255, x_test.astype('float32') / 255
 
     if arg.data_set == 'CIFAR10':
-        if data_type == 'random':
-            return np.random.rand(10**4, 32, 32, 3), np.random.randint(0, 10, size=[10**4])
-        elif data_type == 'random_100':
-            return 200*np.random.rand(10**4, 32, 32, 3)-100, np.random.randint(0, 10, size=[10**4])
-        elif data_type == 'random_1000':
-            return 2000*np.random.rand(10**4, 32, 32, 3)-1000, np.random.randint(0, 10, size=[10**4])
-        elif data_type == 'random_10000':
-            return 20000*np.random.rand(10**4, 32, 32, 3)-10000, np.random.randint(0, 10, size=[10**4])
-
         from tensorflow.keras.datasets import cifar10
         (x_train, y_train), (x_test, y_test) = cifar10.load_data()
     elif arg.data_set == 'MNIST' or arg.data_set == 'Fashion MNIST':
-        if data_type == 'random':
-            return np.random.rand(10**4, 28, 28, 1), np.random.randint(0, 10, size=[10**4])
-        elif data_type == 'random_100':
-            return 200*np.random.rand(10**4, 28, 28, 1)-100, np.random.randint(0, 10, size=[10**4])
-        elif data_type == 'random_1000':
-            return 2000 * np.random.rand(10 ** 4, 28, 28, 3) - 1000, np.random.randint(0, 10, size=[10 ** 4])
-        elif data_type == 'random_10000':
-            return 20000 * np.random.rand(10 ** 4, 28, 28, 3) - 10000, np.random.randint(0, 10, size=[10 ** 4])
-
-
         from tensorflow.keras.datasets import mnist
         (x_train, y_train), (x_test, y_test) = mnist.load_data()
         x_train = np.expand_dims(x_train, axis=3)
         x_test = np.expand_dims(x_test, axis=3)
     elif arg.data_set == 'Fashion MNIST':
-        if data_type == 'random':
-            return np.random.rand(10**4, 28, 28, 1), np.random.randint(0, 10, size=[10**4])
-        elif data_type == 'random_100':
-            return 200*np.random.rand(10**4, 28, 28, 1)-100, np.random.randint(0, 10, size=[10**4])
-        elif data_type == 'random_1000':
-            return 2000*np.random.rand(10**4, 28, 28, 3)-1000, np.random.randint(0, 10, size=[10**4])
-        elif data_type == 'random_10000':
-            return 20000*np.random.rand(10**4, 28, 28, 3)-10000, np.random.randint(0, 10, size=[10**4])
-
         from tensorflow.keras.datasets import fashion_mnist
         (x_train, y_train), (x_test, y_test) = fashion_mnist.load_data()
         x_train = np.expand_dims(x_train, axis=3)
         x_test = np.expand_dims(x_test, axis=3)
-    else:
-        return None
 
     x_train, x_test = scale_pixels(x_train, x_test)
     y_train, y_test = np.squeeze(y_train), np.squeeze(y_test)
 
     if arg.network_type_coarse == 'ResNet':
-        x_train, x_test= subtract_pixel_mean(x_train, x_test)
+        x_train, x_test = subtract_pixel_mean(x_train, x_test)
+    return {'training': (x_train, y_train), 'test': (x_test, y_test)}
+
+
+def load_cached_data(arg, split):
+    # The data set is decoded and preprocessed once, later loads memory-map the .npy files read-only, so slicing
+    # them only reads the selected data points.
+    paths = [get_data_cache_path(arg, split, name) for name in ['data', 'labels']]
+    if not all(os.path.isfile(path) for path in paths):
+        for decoded_split, arrays in decode_data(arg).items():
+            for name, array in zip(['data', 'labels'], arrays):
+                path = get_data_cache_path(arg, decoded_split, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open_atomically(path) as cache_file:
+                    np.save(cache_file, array)
+    return tuple(np.load(path, mmap_mode='r') for path in paths)
+
+
+# Random data types: the points are uniformly distributed in [-scale, scale]^d, or in [0, 1]^d for 'random'.
+RANDOM_DATA_SCALES = {'random': None, 'random_hypercube': None, 'random_100': 100, 'random_1000': 1000,
+                      'random_10000': 10000}
+
+
+def get_data_shape(arg):
+    if arg.data_set == 'CIFAR10':
+        return 32, 32, 3
+    elif arg.data_set == 'MNIST' or arg.data_set == 'Fashion MNIST':
+        return 28, 28, 1
+    return None
+
+
+def generate_random_data(arg, data_type, chunk_size=2 ** 12):
+    # The random data points are generated once for every seed and cached like the data sets. Chunk i is drawn from
+    # generators seeded with random_seed and i, so the points are generated chunk by chunk without holding them in
+    # memory, and the first points do not depend on the number of points.
+    scale = RANDOM_DATA_SCALES[data_type]
+    variant = '_'.join([arg.data_set.replace(' ', '_'), 'random' if scale is None else 'random_' + str(scale),
+                        'seed', str(arg.random_seed), str(arg.no_random_points)])
+    paths = [os.path.join(get_main_directory(), 'Data_Cache', variant + '_' + name + '.npy') for name in ['data',
+                                                                                                          'labels']]
+    if not all(os.path.isfile(path) for path in paths):
+        os.makedirs(os.path.dirname(paths[0]), exist_ok=True)
+        shapes = [(arg.no_random_points,) + get_data_shape(arg), (arg.no_random_points,)]
+        dtypes = [np.dtype('float32'), np.dtype('int64')]
+        with open_atomically(paths[0]) as data_file, open_atomically(paths[1]) as labels_file:
+            for file, shape, dtype in zip([data_file, labels_file], shapes, dtypes):
+                np.lib.format.write_array_header_1_0(file, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                            'fortran_order': False, 'shape': shape})
+            for chunk_idx, lower in enumerate(range(0, arg.no_random_points, chunk_size)):
+                no_points = min(lower + chunk_size, arg.no_random_points) - lower
+                chunk = np.random.default_rng([arg.random_seed, chunk_idx, 0]).random((no_points,) + shapes[0][1:],
+                                                                                      dtype='float32')
+                if scale is not None:
+                    chunk = 2 * scale * chunk - scale
+                chunk.tofile(data_file)
+                np.random.default_rng([arg.random_seed, chunk_idx, 1]).integers(0, 10, size=no_points).tofile(
+                    labels_file)
+    return tuple(np.load(path, mmap_mode='r') for path in paths)
+
+
+# load train and test dataset
+def load_data(arg, data_type='all'):
+    if get_data_shape(arg) is None:
+        return None
+    if data_type in RANDOM_DATA_SCALES:
+        return generate_random_data(arg, data_type)
 
     if data_type == 'all':
-        return x_train, y_train, x_test, y_test
-    elif data_type == 'training':
-        return x_train, y_train
-    elif data_type == 'test':
-        return x_test, y_test
\ No newline at end of file
+        return load_cached_data(arg, 'training') + load_cached_data(arg, 'test')
+    elif data_type == 'training' or data_type == 'test':
+        return load_cached_data(arg, data_type)
@@ -0,0 +1,48 @@
+import numpy as np
+import os
+import shutil
+from Utilities.Custom_Settings import configure_gpu
+from Utilities.Parallel_Extraction import create_process_pool, create_shared_directory, limit_threads
+
+
+# The arguments and the memory-mapped data points of the worker process.
+worker_state = {'arg': None, 'data_points': None}
+
+
+def initialize_epoch_worker(no_threads, arg, data_paths, error_settings):
+    np.seterr(**error_settings)
+    limit_threads(no_threads)
+    configure_gpu(arg)
+    worker_state['arg'] = arg
+    worker_state['data_points'] = tuple(np.load(path, mmap_mode='r') for path in data_paths)
+
+
+def process_epoch_in_worker(process_epoch, epoch_number):
+    return process_epoch(worker_state['arg'], epoch_number, worker_state['data_points'])
+
+
+def run_epochs(arg, epoch_numbers, process_epoch, data_points, no_processes=1):
+    # Calls process_epoch(arg, epoch_number, data_points) for every epoch and returns the results in the order of
+    # epoch_numbers. The data points are loaded once by the caller. With more than one process, the epochs are
+    # distributed over spawned processes which share the data points read-only through memory-mapped files, so
+    # process_epoch has to be a module-level function.
+    no_processes = min(no_processes, len(epoch_numbers))
+    if no_processes <= 1:
+        return [process_epoch(arg, epoch_number, data_points) for epoch_number in epoch_numbers]
+
+    directory = create_shared_directory('tropex_data_')
+    try:
+        data_paths = []
+        for array_idx, array in enumerate(data_points):
+            data_paths.append(os.path.join(directory, str(array_idx) + '.npy'))
+            np.save(data_paths[-1], array)
+        pool = create_process_pool(no_processes, initialize_epoch_worker, (arg, data_paths, np.geterr()))
+        try:
+            # One epoch per task, as the epochs take long and differ in their running times.
+            return pool.starmap(process_epoch_in_worker, [(process_epoch, epoch_number) for epoch_number in
+                                                          epoch_numbers], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,478 @@
+import copy
+import numpy as np
+import scipy.sparse
+import tensorflow as tf
+from Utilities.Tropical_Helper_Functions import get_layer_type, get_pooling_padding
+
+# The activation patterns set many entries of B to zero. Below these fractions of nonzero entries, B is multiplied
+# with the weights of convolutional and dense layers as a sparse matrix. The sparse transposed convolution has a cost
+# that hardly shrinks with the density: on CPU it was faster for B with 128 channels at a density of 0.03, but slower
+# for B with 32 or 64 channels even at 0.01.
+DENSITY_THRESHOLDS = {'conv2d': 0.03, 'dense': 0.2}
+
+
+class Extraction_Plan:
+    # Everything transform_batch needs from the network, read out of the Keras layers once per network/epoch.
+    # steps holds one dictionary per layer in the order of the backward pass (from network.layers[-3] to
+    # network.layers[0]); the tropical back-propagation only runs array kernels on them.
+    def __init__(self, network, convolution_backend='tensorflow'):
+        # convolution_backend: 'tensorflow' back-propagates through convolutional layers with
+        # tf.nn.conv2d_transpose, 'numpy' with transpose_convolution.
+        self.convolution_backend = convolution_backend
+        self.layer_names = [layer.name for layer in network.layers]
+        self.no_layers = len(network.layers)
+        has_branches = any(get_layer_type(layer) == 'add' for layer in network.layers)
+        self.steps = []
+        for layer_idx, layer in reversed(list(enumerate(network.layers[0:-2]))):
+            self.steps.append(compile_step(layer_idx, layer, has_branches))
+        self.compile_last_layer(network.layers[-2])
+        self.compile_maximal_terms()
+        # Output arrays of the dense layers, reused by all batches, see get_buffer.
+        self.buffers = {}
+
+    def compile_last_layer(self, last_layer):
+        self.last_layer_type = get_layer_type(last_layer)
+        if self.last_layer_type == 'dense':
+            weights, bias = last_layer.get_weights()
+            weights = weights.astype('float64')
+            bias = bias.astype('float64')
+            W = np.vstack([bias, weights]).transpose()
+            self.last_layer_input_shape = None
+        elif self.last_layer_type == 'global':
+            h, w, c = last_layer.input_shape[1:]
+            W = np.zeros([c, h * w, c])
+            for gamma in range(c):
+                W[gamma, :, gamma] = 1 / (h * w)
+            W = W.reshape(c, -1)
+            W = np.hstack([np.zeros([c, 1]), W])
+            self.last_layer_input_shape = (h, w, c)
+        else:
+            raise Exception('Invalid type of the last layer.')
+        self.W = W
+        self.A_minus = np.expand_dims(np.sum((-W) * (W < 0), axis=0), axis=0)
+        self.A_plus = W + self.A_minus
+        self.B_max = np.max(np.vstack([self.A_plus, self.A_minus]), axis=0)
+
+    def compile_maximal_terms(self):
+        # B_max only depends on the weights, not on the batch. It is back-propagated through all layers once here
+        # and every convolutional and dense step keeps its K, the correction term that is added to B and B_max.
+        B_max = self.B_max[1:]
+        if self.last_layer_type == 'global':
+            B_max = B_max.reshape((-1,) + self.last_layer_input_shape)
+        input_names = []
+        for step in self.steps:
+            layer_type = step['type']
+            if len(input_names) > 1:
+                if input_names[0] == step['name']:
+                    B_max = B_max_0
+                elif input_names[1] == step['name']:
+                    B_max = B_max_1
+            if layer_type == 'add':
+                input_names = list(step['input_names'])
+                B_max_0 = B_max
+                B_max_1 = B_max
+            elif layer_type == 'average':
+                pool_size = step['pool_size']
+                B_max = np.repeat(np.repeat(B_max, repeats=pool_size[0], axis=1), repeats=pool_size[1], axis=2)
+                B_max = B_max / (pool_size[0] * pool_size[1])
+            elif layer_type == 'batch':
+                B_max = B_max * step['abs_scale']
+            elif layer_type == 'conv2d':
+                step['K'] = self.transpose_convolution(B_max, step['filt_neg'], step)
+                B_max = self.transpose_convolution(B_max, step['filt_pos'], step) + step['K']
+            elif layer_type == 'dense':
+                step['K'] = np.dot(B_max, step['W_neg'])
+                B_max = np.dot(B_max, step['W_pos']) + step['K']
+            elif layer_type == 'flatten':
+                B_max = B_max.reshape((-1,) + step['input_shape'])
+            elif layer_type == 'max':
+                # B_max is not negative, so the sum over all windows of a position bounds its coefficients.
+                B_max = np.repeat(B_max[..., np.newaxis], step['pool_size'][0] * step['pool_size'][1], axis=-1)
+                B_max = add_windows(B_max, step)
+
+            if len(input_names) > 1:
+                if input_names[0] == step['name']:
+                    B_max_0 = B_max
+                    input_names[0] = step['input_name']
+                elif input_names[1] == step['name']:
+                    B_max_1 = B_max
+                    input_names[1] = step['input_name']
+
+                if input_names[0] == input_names[1]:
+                    B_max = B_max_0 + B_max_1
+                    input_names = []
+
+    def transpose_convolution(self, B, filt, step):
+        # The transposed convolution of the layer of step, computed with the convolution backend of the plan.
+        if self.convolution_backend == 'numpy':
+            return transpose_convolution(B, filt, step)
+        return tf.nn.conv2d_transpose(B, filt, output_shape=(B.shape[0],) + step['input_shape'],
+                                      strides=step['strides'], padding='SAME').numpy()
+
+    def get_buffer(self, layer_idx, shape, dtype):
+        # Array of the given shape for the output of a layer. The buffer of a layer only grows, so after the first
+        # batches no memory is allocated for it. The array is overwritten by the next batch.
+        key = (layer_idx, np.dtype(dtype).str)
+        if key not in self.buffers or self.buffers[key].shape[0] < shape[0] or self.buffers[key].shape[1:] != shape[1:]:
+            self.buffers[key] = np.empty(shape, dtype=dtype)
+        return self.buffers[key][0:shape[0]]
+
+    def astype(self, dtype):
+        # Copy of the plan whose floating point arrays are cast to dtype, e.g. for an extraction in float32. The plan
+        # itself is compiled in float64.
+        def cast(value):
+            if isinstance(value, np.ndarray) and value.dtype.kind == 'f':
+                return value.astype(dtype)
+            return value
+
+        # The copies share the buffers, which are kept per dtype.
+        plan = copy.copy(self)
+        for name, value in vars(self).items():
+            setattr(plan, name, cast(value))
+        plan.steps = [{key: cast(value) for key, value in step.items()} for step in self.steps]
+        return plan
+
+    def get_folder_name(self, index):
+        return '_'.join([str(index), self.layer_names[index]])
+
+    def get_initial_terms(self, sign, labels):
+        # Data points with the same starting term share a row of B: row_index[point] is the row of B that belongs to
+        # the point. The signs are back-propagated one after the other, as a stacked pass of pos and neg was not
+        # faster on CPU and doubled the peak size of B.
+        if sign == 'pos':
+            B = self.A_plus
+            row_index = labels
+        elif sign == 'neg':
+            B = self.A_minus
+            row_index = np.zeros(labels.shape, dtype=int)
+        elif sign == 'linear':
+            B = self.W
+            row_index = labels
+        else:
+            raise Exception('Invalid sign.')
+        B_max = np.zeros_like(self.A_plus[0]) if sign == 'linear' else self.B_max
+        B = np.array(B)
+        row_index = np.array(row_index)
+
+        bias = B[:, 0:1]
+        B_max = B_max[1:]
+        B = B[:, 1:]
+
+        if self.last_layer_type == 'global':
+            B = B.reshape((-1,) + self.last_layer_input_shape)
+            B_max = B_max.reshape((-1,) + self.last_layer_input_shape)
+        return B, bias, B_max, row_index
+
+
+def compile_step(layer_idx, layer, has_branches):
+    step = {'index': layer_idx, 'name': layer.name, 'type': get_layer_type(layer)}
+    if step['type'] == 'add':
+        step['input_names'] = [input.name.split('/')[0] for input in layer.input]
+    elif has_branches:
+        step['input_name'] = layer.input.name.split('/')[0]
+
+    if step['type'] == 'average':
+        step['pool_size'] = layer.pool_size
+    elif step['type'] == 'batch':
+        gamma, beta, mean, var = layer.get_weights()
+        gamma = gamma[np.newaxis, np.newaxis, np.newaxis, :]
+        beta = beta[np.newaxis, np.newaxis, np.newaxis, :]
+        mean = mean[np.newaxis, np.newaxis, np.newaxis, :]
+        var = var[np.newaxis, np.newaxis, np.newaxis, :]
+        eps = layer.epsilon
+        # data_after_batchnorm = ((data_before_batchnorm - mean)/np.sqrt(var+epsilon))*gamma + beta
+        scale = gamma / np.sqrt(var + eps)
+        translation = np.squeeze(-mean * scale + beta)
+        _, input_height, input_width, input_channels = layer.input_shape
+        step['scale'] = scale.astype('float64')
+        step['abs_scale'] = np.abs(step['scale'])
+        step['bias'] = np.tile(translation, input_height * input_width).astype('float64')[:, np.newaxis]
+    elif step['type'] == 'conv2d':
+        output_height, output_width, output_channels = layer.output_shape[1:]
+        filt, layer_bias = layer.get_weights()
+        filt = filt.astype('float64')
+        layer_bias = layer_bias.astype('float64')
+        step['filt'] = filt
+        step['filt_neg'] = (-filt) * (filt < 0)
+        step['filt_pos'] = filt * (filt > 0)
+        step['bias'] = np.tile(layer_bias, output_height * output_width)[:, np.newaxis]
+        step['strides'] = (1,) + tuple(layer.strides) + (1,)
+        step['input_shape'] = tuple(layer.input_shape[1:])
+        # The padding of 'SAME' convolutions at the top and left, and the size of the padded input, see add_columns.
+        input_height, input_width = step['input_shape'][0:2]
+        filter_height, filter_width = filt.shape[0:2]
+        stride_height, stride_width = layer.strides
+        step['padding'] = (max((output_height - 1) * stride_height + filter_height - input_height, 0) // 2,
+                           max((output_width - 1) * stride_width + filter_width - input_width, 0) // 2)
+        step['padded_shape'] = (max((output_height - 1) * stride_height + filter_height,
+                                    step['padding'][0] + input_height),
+                                max((output_width - 1) * stride_width + filter_width, step['padding'][1] + input_width))
+    elif step['type'] == 'dense':
+        W, layer_bias = layer.get_weights()
+        W = W.astype('float64')
+        W = W.transpose()
+        step['W'] = W
+        step['W_neg'] = (-W) * (W < 0)
+        step['W_pos'] = W * (W > 0)
+        step['bias'] = layer_bias.astype('float64')[:, np.newaxis]
+    elif step['type'] == 'flatten':
+        step['input_shape'] = tuple(layer.input_shape[1:])
+    elif step['type'] == 'leaky':
+        step['alpha'] = layer.alpha
+    elif step['type'] == 'max':
+        step['input_shape'] = tuple(layer.input_shape[1:])
+        step['pool_size'] = tuple(layer.pool_size)
+        step['strides'] = tuple(layer.strides)
+        step['padding'], step['padded_shape'] = get_pooling_padding(layer)
+        # Position in the flattened padded input of every entry of every window, windows in the order of the
+        # activation pattern and entries in the order of compute_max_pooling_pattern.
+        output_height, output_width, channels = layer.output_shape[1:]
+        stride_height, stride_width = layer.strides
+        window_rows = np.add.outer(np.arange(output_height) * stride_height, np.arange(layer.pool_size[0]))
+        window_columns = np.add.outer(np.arange(output_width) * stride_width, np.arange(layer.pool_size[1]))
+        positions = window_rows[:, np.newaxis, :, np.newaxis] * step['padded_shape'][1] + \
+            window_columns[np.newaxis, :, np.newaxis, :]
+        positions = positions[:, :, np.newaxis, :, :] * channels + np.arange(channels)[:, np.newaxis, np.newaxis]
+        step['window_index'] = positions.reshape([output_height * output_width * channels, -1])
+    return step
+
+
+def share_rows(B, bias, row_index, activation_pattern):
+    # A row of B is shared by all data points that start with the same term and agree on all activation patterns
+    # seen so far. Rows whose data points disagree on activation_pattern are split up. Returns the activation
+    # pattern that belongs to every new row. If no row is split up, B and bias are returned as they are, not copied.
+    no_points = activation_pattern.shape[0]
+    flat_pattern = activation_pattern.reshape([no_points, -1])
+    if flat_pattern.dtype == bool:
+        flat_pattern = np.packbits(flat_pattern, axis=1)
+    flat_pattern = np.ascontiguousarray(flat_pattern)
+    pattern_rows = flat_pattern.view(np.dtype((np.void, flat_pattern.dtype.itemsize * flat_pattern.shape[1])))
+    _, pattern_representatives, pattern_ids = np.unique(pattern_rows.ravel(), return_index=True,
+                                                        return_inverse=True)
+    no_patterns = len(pattern_representatives)
+    keys = row_index * no_patterns + pattern_ids.reshape([-1])
+    keys, new_row_index = np.unique(keys, return_inverse=True)
+    parents = keys // no_patterns
+    row_patterns = activation_pattern[pattern_representatives[keys % no_patterns]]
+    if np.array_equal(parents, np.arange(B.shape[0])):
+        return B, bias, new_row_index.reshape(row_index.shape), row_patterns
+    return B[parents], bias[parents], new_row_index.reshape(row_index.shape), row_patterns
+
+
+def apply_activation_pattern(B, bias, row_index, activation_pattern, alpha=0):
+    B, bias, row_index, row_patterns = share_rows(B, bias, row_index, activation_pattern)
+    if alpha == 0:
+        B[row_patterns] = 0
+    else:
+        B[row_patterns] *= alpha
+    return B, bias, row_index
+
+
+def add_windows(B, step):
+    # Adds the entries B[row, y, x, channel, position] of the windows of a max pooling layer to their positions in
+    # its input, where overlapping windows meet they are summed up.
+    no_rows = B.shape[0]
+    padded_size = step['padded_shape'][0] * step['padded_shape'][1] * step['input_shape'][2]
+    positions = (np.arange(no_rows) * padded_size)[:, np.newaxis] + step['window_index'].reshape(-1)
+    result = np.bincount(positions.reshape(-1), weights=B.reshape(-1), minlength=no_rows * padded_size)
+    result = result.astype(B.dtype, copy=False).reshape((no_rows,) + step['padded_shape'] + step['input_shape'][2:])
+    return remove_padding(result, step)
+
+
+def add_maxima(B, maxima, step):
+    # Passes the entry B[row, y, x, channel] of every window of a max pooling layer on to the position
+    # maxima[row, y, x, channel] of its maximum within the window, where overlapping windows meet they are summed up.
+    no_rows = B.shape[0]
+    pool_height, pool_width = step['pool_size']
+    if step['strides'] == step['pool_size']:
+        # The windows tile the padded input, so the window entries are a reshaped view of it.
+        output_height, output_width = B.shape[1:3]
+        result = np.zeros((no_rows,) + step['padded_shape'] + step['input_shape'][2:], dtype=B.dtype)
+        windows = result[:, 0:output_height * pool_height, 0:output_width * pool_width, :].reshape(
+            (no_rows, output_height, pool_height, output_width, pool_width) + step['input_shape'][2:])
+        for position in range(pool_height * pool_width):
+            np.copyto(windows[:, :, position // pool_width, :, position % pool_width, :], B, where=maxima == position)
+        return remove_padding(result, step)
+    padded_size = step['padded_shape'][0] * step['padded_shape'][1] * step['input_shape'][2]
+    positions = step['window_index'][np.arange(step['window_index'].shape[0]), maxima.reshape([no_rows, -1])]
+    positions += (np.arange(no_rows) * padded_size)[:, np.newaxis]
+    result = np.bincount(positions.reshape(-1), weights=B.reshape(-1), minlength=no_rows * padded_size)
+    result = result.astype(B.dtype, copy=False).reshape((no_rows,) + step['padded_shape'] + step['input_shape'][2:])
+    return remove_padding(result, step)
+
+
+def compute_density(B, max_rows=64):
+    # Fraction of nonzero entries of B, estimated from at most about max_rows evenly spaced rows.
+    if B.size == 0:
+        return 1.0
+    sample = B[::max(1, B.shape[0] // max_rows)]
+    return np.count_nonzero(sample) / sample.size
+
+
+def add_columns(result, columns, i, j, step):
+    # col2im for the filter position (i, j): columns[row, y, x] is the product of B[row, y, x] with the weights
+    # filt[i, j] and belongs to the position (y * stride_height + i, x * stride_width + j) of the padded input.
+    height, width = columns.shape[1:3]
+    stride_height, stride_width = step['strides'][1:3]
+    result[:, i:i + (height - 1) * stride_height + 1:stride_height,
+           j:j + (width - 1) * stride_width + 1:stride_width, :] += columns
+
+
+def remove_padding(result, step):
+    input_height, input_width = step['input_shape'][0:2]
+    pad_top, pad_left = step['padding']
+    return result[:, pad_top:pad_top + input_height, pad_left:pad_left + input_width, :]
+
+
+def transpose_convolution(B, filt, step, max_chunk_bytes=2 ** 26):
+    # Same as tf.nn.conv2d_transpose(B, filt, output_shape, step['strides'], padding='SAME') for the convolutional
+    # layer of step, in NumPy: one product of B with the filter matrix gives the columns of all filter positions,
+    # which col2im adds to the padded result. The rows of B are processed in chunks of max_chunk_bytes of columns.
+    no_rows, height, width, output_channels = B.shape
+    filter_height, filter_width, input_channels = filt.shape[0:3]
+    filter_matrix = filt.transpose([3, 0, 1, 2]).reshape([output_channels, -1])
+    result = np.zeros((no_rows,) + step['padded_shape'] + (input_channels,), dtype=B.dtype)
+    chunk_size = max(1, max_chunk_bytes // (height * width * filter_matrix.shape[1] * B.dtype.itemsize))
+    for lower in range(0, no_rows, chunk_size):
+        upper = min(lower + chunk_size, no_rows)
+        columns = np.dot(B[lower:upper].reshape([-1, output_channels]), filter_matrix)
+        columns = columns.reshape([upper - lower, height, width, filter_height, filter_width, input_channels])
+        for i in range(filter_height):
+            for j in range(filter_width):
+                add_columns(result[lower:upper], columns[:, :, :, i, j], i, j, step)
+    return remove_padding(result, step)
+
+
+def transpose_convolution_sparse(B, filt, step):
+    # transpose_convolution for a sparse B: only the nonzero entries of B are multiplied. B is turned into a CSR
+    # matrix with one row per position, its product with the weights of each filter position is added by col2im.
+    no_rows, height, width, output_channels = B.shape
+    filter_height, filter_width, input_channels = filt.shape[0:3]
+    sparse_B = scipy.sparse.csr_matrix(B.reshape([-1, output_channels]))
+    result = np.zeros((no_rows,) + step['padded_shape'] + (input_channels,), dtype=B.dtype)
+    for i in range(filter_height):
+        for j in range(filter_width):
+            columns = sparse_B @ filt[i, j].transpose()
+            add_columns(result, columns.reshape([no_rows, height, width, input_channels]), i, j, step)
+    return remove_padding(result, step)
+
+
+def backpropagate(plan, B, bias, B_max, row_index, activation_patterns, after_layer=None,
+                  density_thresholds=DENSITY_THRESHOLDS, densities=None):
+    # Merges the tropical terms B (with biases bias) of the last layer backwards through all layers of the plan.
+    # The terms of the data points are B[row_index] and bias[row_index]. The returned B may be a buffer of the plan that
+    # the next call overwrites.
+    # B_max has to be the one of plan.get_initial_terms: the correction terms K it leads to are compiled into the
+    # plan, see compile_maximal_terms. For linear terms B_max is zero, and so is K.
+    # after_layer(layer_idx, layer_type, B, bias, row_index) is called after every layer, e.g. for saving and logging.
+    # B is multiplied as a sparse matrix by convolutional and dense layers if its density is below
+    # density_thresholds[layer_type]; the estimated density of B on entering these layers is recorded in
+    # densities[layer_idx] if densities is given.
+    def is_sparse(B):
+        density = compute_density(B)
+        if densities is not None:
+            densities[step['index']] = density
+        return density < density_thresholds[step['type']]
+
+    def add(B_0, bias_0, row_index_0, B_1, bias_1, row_index_1):
+        no_rows_1 = B_1.shape[0]
+        keys, row_index = np.unique(row_index_0 * no_rows_1 + row_index_1, return_inverse=True)
+        B = B_0[keys // no_rows_1] + B_1[keys % no_rows_1]
+        bias = bias_0[keys // no_rows_1] + bias_1[keys % no_rows_1]
+        return B, bias, row_index.reshape(row_index_0.shape)
+
+    def avpool(B, pool_size):
+        pool_divisor = pool_size[0] * pool_size[1]
+        B = np.repeat(np.repeat(B, repeats=pool_size[0], axis=1), repeats=pool_size[1], axis=2)
+        B /= pool_divisor
+        return B
+
+    def batch(B, bias):
+        bias += np.dot(B.reshape([B.shape[0], -1]), step['bias'])
+        B = B * step['scale']
+        return B, bias
+
+    def copy(B, bias, row_index):
+        B_0 = B
+        bias_0 = bias
+        row_index_0 = row_index
+        B_1 = np.copy(B)
+        bias_1 = np.copy(bias)
+        row_index_1 = np.copy(row_index)
+        return B_0, bias_0, row_index_0, B_1, bias_1, row_index_1
+
+    def convolution(B, bias):
+        bias += np.dot(B.reshape([B.shape[0], -1]), step['bias'])
+        if is_sparse(B):
+            B = transpose_convolution_sparse(B, step['filt'], step)
+        else:
+            B = plan.transpose_convolution(B, step['filt'], step)
+        if has_maximal_terms:
+            B += step['K']
+        return B, bias
+
+    def dense(B, bias):
+        if is_sparse(B):
+            sparse_B = scipy.sparse.csr_matrix(B)
+            bias += sparse_B @ step['bias']
+            B = sparse_B @ step['W']
+        else:
+            bias += np.dot(B, step['bias'])
+            B = np.dot(B, step['W'], out=plan.get_buffer(step['index'], (B.shape[0], step['W'].shape[1]), B.dtype))
+        if has_maximal_terms:
+            B += step['K']
+        return B, bias
+
+    def maxpool(B, bias, row_index):
+        # Every window passes its entry of B on to the position of its maximum only.
+        B, bias, row_index, maxima = share_rows(B, bias, row_index, next(activation_pattern_iterator))
+        return add_maxima(B, maxima, step), bias, row_index
+
+    has_maximal_terms = np.any(B_max)
+    input_names = []
+    activation_pattern_iterator = iter(activation_patterns)
+    for step in plan.steps:
+        layer_type = step['type']
+        if len(input_names) > 1:
+            if input_names[0] == step['name']:
+                B, bias, row_index = B_0, bias_0, row_index_0
+            elif input_names[1] == step['name']:
+                B, bias, row_index = B_1, bias_1, row_index_1
+        if layer_type == 'add':
+            input_names = list(step['input_names'])
+            B_0, bias_0, row_index_0, B_1, bias_1, row_index_1 = copy(B, bias, row_index)
+        elif layer_type == 'average':
+            B = avpool(B, step['pool_size'])
+        elif layer_type == 'batch':
+            B, bias = batch(B, bias)
+        elif layer_type == 'conv2d':
+            B, bias = convolution(B, bias)
+        elif layer_type == 'dense':
+            B, bias = dense(B, bias)
+        elif layer_type == 'dropout':
+            pass
+        elif layer_type == 'flatten':
+            B = B.reshape((-1,) + step['input_shape'])
+        elif layer_type == 'leaky':
+            B, bias, row_index = apply_activation_pattern(B, bias, row_index, next(activation_pattern_iterator),
+                                                          step['alpha'])
+        elif layer_type == 'max':
+            B, bias, row_index = maxpool(B, bias, row_index)
+        elif layer_type == 're' or layer_type == 'activation':
+            B, bias, row_index = apply_activation_pattern(B, bias, row_index, next(activation_pattern_iterator))
+
+        if len(input_names) > 1:
+            if input_names[0] == step['name']:
+                B_0, bias_0, row_index_0 = B, bias, row_index
+                input_names[0] = step['input_name']
+            elif input_names[1] == step['name']:
+                B_1, bias_1, row_index_1 = B, bias, row_index
+                input_names[1] = step['input_name']
+
+            if input_names[0] == input_names[1]:
+                B, bias, row_index = add(B_0, bias_0, row_index_0, B_1, bias_1, row_index_1)
+                input_names = []
+
+        if after_layer is not None:
+            after_layer(step['index'], layer_type, B, bias, row_index)
+    return B, bias, row_index
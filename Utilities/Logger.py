@@ -50,7 +50,8 @@ def print_end(start_time):
     return
 
 
-def get_logger(arg):
+def get_logger(arg, epoch_number=None):
+    # With an epoch number, the logger writes to its own file, e.g. for epochs that are processed in parallel.
     save_dir = get_saving_directory(arg)
     transformation_path = create_directory(save_dir, arg.data_type.capitalize())
     file_name = sys.argv[0].split('/')[-1].split('.')[0]
@@ -93,6 +94,9 @@ def get_logger(arg):
     else:
         logger = None
         logger_path = ''
+    if epoch_number is not None:
+        logger = logging.getLogger(logger.name + '_epoch_' + str(epoch_number))
+        logger_path = os.path.splitext(logger_path)[0] + '_epoch_' + str(epoch_number) + '.log'
     logger.setLevel(logging.INFO)
 
     file_handler = logging.FileHandler(logger_path, mode='w')
@@ -0,0 +1,164 @@
+import numpy as np
+from Utilities.Tropical_Evaluation import compute_blockwise_max, iterate_term_blocks
+
+# Above this fraction of probed partitions, the approximate search is slower than the exact search, which evaluates
+# all terms in large blocks instead of one partition at a time (0.9 times its running time at 0.3 on one core).
+MAX_PROBE_FRACTION = 0.25
+
+
+class MIPS_Index:
+    # Approximate maximum inner product search over the terms [bias, coefficients] of a tropical function.
+    # With M the maximal norm of the terms, the augmented terms [t, sqrt(M^2 - |t|^2)] all have norm M, and for the
+    # query q = [1, x] the term with the largest inner product is the augmented term closest to [q, 0]. The
+    # augmented terms are partitioned by k-means (inverted file); a query only visits the terms of the no_probes
+    # partitions with the closest centroids.
+    def __init__(self, centroids, list_offsets, term_order, no_probes, recall=None, fingerprint=''):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.term_order = term_order
+        self.no_probes = no_probes
+        self.recall = recall
+        self.fingerprint = fingerprint
+
+    @property
+    def no_lists(self):
+        return self.centroids.shape[0]
+
+    @property
+    def probe_fraction(self):
+        return self.no_probes / self.no_lists
+
+    @classmethod
+    def build(cls, terms, no_lists=None, no_iterations=10, sample_size=2 ** 14, block_size=2 ** 12, seed=0,
+              fingerprint=''):
+        no_terms = terms.shape[0]
+        if no_lists is None:
+            no_lists = max(1, int(4 * np.sqrt(no_terms)))
+        no_lists = min(no_lists, no_terms)
+        squared_norms = np.concatenate([np.sum(block ** 2, axis=1) for _, block in
+                                        iterate_term_blocks(terms, block_size)])
+        max_squared_norm = np.max(squared_norms)
+
+        def augment(block, block_squared_norms):
+            extra = np.sqrt(np.maximum(max_squared_norm - block_squared_norms, 0))
+            return np.hstack([np.asarray(block, dtype='float64'), extra[:, np.newaxis]])
+
+        random_state = np.random.RandomState(seed)
+        sample = np.sort(random_state.choice(no_terms, size=min(sample_size, no_terms), replace=False))
+        centroids = compute_k_means(augment(terms[sample], squared_norms[sample]), no_lists, no_iterations,
+                                    random_state)
+
+        assignment = []
+        for lower, block in iterate_term_blocks(terms, block_size):
+            block_squared_norms = squared_norms[lower:lower + block.shape[0]]
+            assignment.append(assign_to_centroids(augment(block, block_squared_norms), centroids))
+        assignment = np.concatenate(assignment)
+        # Stable, so the terms of every partition stay in ascending order.
+        term_order = np.argsort(assignment, kind='stable')
+        list_offsets = np.searchsorted(assignment[term_order], np.arange(no_lists + 1))
+        return cls(centroids, list_offsets, term_order, no_probes=no_lists, fingerprint=fingerprint)
+
+    def calibrate(self, terms, data, recall_target, sample_size=2 ** 10, seed=0):
+        # Chooses the smallest number of probed partitions for which the approximate search agrees with the exact
+        # search on at least recall_target of a sample of the data points. The number is doubled until the target is
+        # met and then found by bisection between the last number that failed and the first that met it.
+        sample = sample_data_points(data, sample_size, seed)
+        _, exact_indices = compute_blockwise_max(terms, sample)
+        recalls = {}
+
+        def meets_target(no_probes):
+            recalls[no_probes] = np.mean(self.search(terms, sample, no_probes) == exact_indices[0])
+            return recalls[no_probes] >= recall_target
+
+        failing_no_probes = 0
+        passing_no_probes = 1
+        while passing_no_probes < self.no_lists and not meets_target(passing_no_probes):
+            failing_no_probes = passing_no_probes
+            passing_no_probes = min(2 * passing_no_probes, self.no_lists)
+        if passing_no_probes not in recalls:
+            meets_target(passing_no_probes)
+        while passing_no_probes - failing_no_probes > 1:
+            middle_no_probes = (failing_no_probes + passing_no_probes) // 2
+            if meets_target(middle_no_probes):
+                passing_no_probes = middle_no_probes
+            else:
+                failing_no_probes = middle_no_probes
+        self.no_probes = passing_no_probes
+        self.recall = recalls[passing_no_probes]
+        return self.recall
+
+    def search(self, terms, data, no_probes=None):
+        # Input: (data_size, no_data_points)-sized data. Output: indices of the (approximately) maximal terms.
+        if no_probes is None:
+            no_probes = self.no_probes
+        no_data_points = data.shape[1]
+        queries = np.vstack([np.ones([1, no_data_points]), data]).astype('float64')
+        # argmin of |c - [q, 0]|^2 = |c|^2 - 2 <c, [q, 0]> + |q|^2
+        centroid_distances = np.sum(self.centroids ** 2, axis=1)[:, np.newaxis] - \
+            2 * np.dot(self.centroids[:, :-1], queries)
+        if no_probes < self.no_lists:
+            probes = np.argpartition(centroid_distances, no_probes - 1, axis=0)[0:no_probes]
+        else:
+            probes = np.tile(np.arange(self.no_lists)[:, np.newaxis], [1, no_data_points])
+        # The data points that probe each partition.
+        probed_lists = probes.ravel()
+        probing_points = np.tile(np.arange(no_data_points), probes.shape[0])
+        probe_order = np.argsort(probed_lists, kind='stable')
+        probe_offsets = np.searchsorted(probed_lists[probe_order], np.arange(self.no_lists + 1))
+
+        best_values = np.full(no_data_points, -np.inf)
+        best_indices = np.zeros(no_data_points, dtype=np.int64)
+        for list_idx in range(self.no_lists):
+            points = probing_points[probe_order[probe_offsets[list_idx]:probe_offsets[list_idx + 1]]]
+            members = self.term_order[self.list_offsets[list_idx]:self.list_offsets[list_idx + 1]]
+            if points.size == 0 or members.size == 0:
+                continue
+            values = np.dot(np.asarray(terms[members], dtype='float64'), queries[:, points])
+            list_argmax = np.argmax(values, axis=0)
+            list_max = values[list_argmax, np.arange(points.size)]
+            better = list_max > best_values[points]
+            best_values[points[better]] = list_max[better]
+            best_indices[points[better]] = members[list_argmax[better]]
+        return best_indices
+
+    def compute_agreement(self, terms, data, sample_size=2 ** 8, seed=0):
+        # Fraction of a sample of the data points on which the approximate and the exact search agree.
+        sample = sample_data_points(data, sample_size, seed)
+        _, exact_indices = compute_blockwise_max(terms, sample)
+        return np.mean(self.search(terms, sample) == exact_indices[0])
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, list_offsets=self.list_offsets, term_order=self.term_order,
+                 no_probes=self.no_probes, recall=np.nan if self.recall is None else self.recall,
+                 fingerprint=self.fingerprint)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as index:
+            recall = float(index['recall'])
+            return cls(index['centroids'], index['list_offsets'], index['term_order'], int(index['no_probes']),
+                       None if np.isnan(recall) else recall, str(index['fingerprint']))
+
+
+def compute_k_means(points, no_centroids, no_iterations, random_state):
+    # Lloyd's algorithm, starting from no_centroids random points. The centroids of empty clusters stay where they are.
+    centroids = points[random_state.choice(points.shape[0], size=no_centroids, replace=False)]
+    for _ in range(no_iterations):
+        assignment = assign_to_centroids(points, centroids)
+        for centroid_idx in range(no_centroids):
+            members = points[assignment == centroid_idx]
+            if members.shape[0] > 0:
+                centroids[centroid_idx] = np.mean(members, axis=0)
+    return centroids
+
+
+def assign_to_centroids(points, centroids):
+    distances = np.sum(centroids ** 2, axis=1)[np.newaxis, :] - 2 * np.dot(points, centroids.transpose())
+    return np.argmin(distances, axis=1)
+
+
+def sample_data_points(data, sample_size, seed):
+    if data.shape[1] <= sample_size:
+        return data
+    random_state = np.random.RandomState(seed)
+    return data[:, np.sort(random_state.choice(data.shape[1], size=sample_size, replace=False))]
@@ -1,7 +1,7 @@
 import tensorflow as tf
 from tensorflow.keras.layers import ReLU, LeakyReLU, Softmax
 from Utilities.Custom_Activations import split_relu
-from Utilities.Saver import get_network_location
+from Utilities.Saver import compute_file_hash, get_network_location
 from tensorflow.keras.optimizers import Adam, SGD
 from Utilities.Callbacks import get_scheduler
 
@@ -21,4 +21,6 @@ def load_network(arg, epoch_number):
     network_location = get_network_location(arg, epoch_number)
     custom_objects = {"split_relu": split_relu, "LeakyReLU": LeakyReLU(), "ReLU": ReLU(), "Softmax": Softmax(), "lr":get_lr_metric(opt)}
     network = tf.keras.models.load_model(network_location, custom_objects=custom_objects)
+    # Identifies the network in the prediction cache.
+    network.file_hash = compute_file_hash(network_location)
     return network
\ No newline at end of file
@@ -0,0 +1,250 @@
+import copy
+import multiprocessing
+import numpy as np
+import os
+import queue
+import shutil
+import tempfile
+import tensorflow as tf
+from Utilities.Extraction_Plan import backpropagate
+from Utilities.Tropical_Helper_Functions import compute_maximal_difference, get_tropical_filename_ending, \
+    get_tropical_function_directory, get_tropical_shard_record, save_tropical_terms
+
+
+def extract_batch(arg, plan, epoch_number, batch_idx, signs, activation_patterns, true_labels, network_labels,
+                  linear_regions=None, log=None, single_plan=None):
+    # Back-propagates and saves the terms of one batch. Returns the saved shards as (save_dir, sign, batch_idx,
+    # record), they are registered in the manifests by the calling process, and the densities of B. The shards of
+    # the final function come last, so they are only registered once the whole batch is.
+    # With --extraction_precision float32, the terms are back-propagated and saved in float32. single_plan is
+    # plan.astype of --extraction_precision, cast once per epoch by the caller, see choose_extraction_precision.
+    # Only one data point per linear region, linear_regions = activation_patterns.get_linear_regions(network_labels),
+    # is back-propagated; the other data points of the region share its terms.
+    if linear_regions is None:
+        linear_regions = activation_patterns.get_linear_regions(network_labels)
+    representatives, region_index = linear_regions
+    representative_patterns = activation_patterns.select(representatives)
+    saved_shards = []
+    # Density of B on entering the convolutional and dense layers, see backpropagate.
+    densities = {}
+
+    def save(layer_idx, sign, B, bias, row_index):
+        row_index = row_index[region_index]
+        folder_name = plan.get_folder_name(layer_idx)
+        save_dir = get_tropical_function_directory(arg, folder_name, arg.data_type, epoch_number)
+        file_name_ending = get_tropical_filename_ending(batch_idx)
+        save_tropical_terms(os.path.join(save_dir, sign + file_name_ending), true_labels, network_labels, bias, B,
+                            row_index)
+        return save_dir, sign, batch_idx, get_tropical_shard_record(save_dir, sign, batch_idx)
+
+    def extract(current_plan):
+        # The signs are back-propagated one after the other with the same activation patterns.
+        final_shards = []
+        for sign in signs:
+            def after_layer(layer_idx, layer_type, B, bias, row_index):
+                if arg.save_intermediate and layer_type in ['conv2d', 'dense', 'global', 'max']:
+                    saved_shards.append(save(layer_idx, sign, B, bias, row_index))
+                if log is not None:
+                    log('Done with merge ' + str(layer_idx) + ' of ' + str(plan.no_layers - 2) + ' for ' + sign +
+                        ' (' + str(B.shape[0]) + ' distinct terms)')
+
+            B, bias, B_max, row_index = current_plan.get_initial_terms(sign, network_labels[representatives])
+            if arg.save_intermediate:
+                saved_shards.append(save(plan.no_layers - 1, sign, B, bias, row_index))
+            B, bias, row_index = backpropagate(current_plan, B, bias, B_max, row_index, representative_patterns,
+                                               after_layer=after_layer, densities=densities)
+            final_shards.append(save(0, sign, B, bias, row_index))
+        saved_shards.extend(final_shards)
+
+    if arg.extraction_precision == 'float64':
+        extract(plan)
+        return saved_shards, densities
+
+    if single_plan is None:
+        single_plan = plan.astype(arg.extraction_precision)
+    # Values below the smallest float32 are rounded to zero instead of raising.
+    with np.errstate(under='ignore'):
+        extract(single_plan)
+    return saved_shards, densities
+
+
+def get_single_plan(arg, plan):
+    # The plan of the --extraction_precision extraction for extract_batch, None in float64.
+    if arg.extraction_precision == 'float64':
+        return None
+    return plan.astype(arg.extraction_precision)
+
+
+def choose_extraction_precision(arg, single_plan, activation_patterns, network_labels, data, logits, log=None):
+    # The precision of an epoch is decided once, on a sample of its first batch with the activation patterns, network
+    # labels, data and logits of the sample: if the --extraction_precision extraction of the sample is off by more
+    # than --precision_tolerance, the whole epoch is extracted in float64.
+    if arg.extraction_precision == 'float64':
+        return 'float64'
+    with np.errstate(under='ignore'):
+        error = compute_extraction_error(arg, single_plan, activation_patterns, network_labels, data, logits)
+    message = 'Maximal error of the ' + arg.extraction_precision + ' extraction: ' + str(error)
+    if error > arg.precision_tolerance:
+        message += ', the epoch is extracted in float64'
+    print(message)
+    if log is not None:
+        log(message)
+    return arg.extraction_precision if error <= arg.precision_tolerance else 'float64'
+
+
+def compute_extraction_error(arg, plan, activation_patterns, network_labels, data, logits):
+    # Maximal difference between the tropical function and the logits of the network labels on data points with
+    # activation_patterns, data and logits. The terms of the data points are back-propagated with plan and evaluated
+    # at the data points: the term of a data point is maximal there, so max(pos) - max(neg) is the difference of its
+    # pos and neg terms. Linear terms give the logits directly.
+    signs = ['linear'] if arg.extraction_type == 'linear' else ['pos', 'neg']
+    data = np.reshape(data, [data.shape[0], -1]).astype('float64')
+    values = []
+    for sign in signs:
+        B, bias, B_max, row_index = plan.get_initial_terms(sign, network_labels)
+        B, bias, row_index = backpropagate(plan, B, bias, B_max, row_index, activation_patterns)
+        B = B.reshape([B.shape[0], -1]).astype('float64')
+        values.append(np.sum(B[row_index] * data, axis=1) + bias[row_index, 0].astype('float64'))
+    tropical_result = values[0] if len(values) == 1 else values[0] - values[1]
+    network_result = logits[np.arange(data.shape[0]), network_labels]
+    return compute_maximal_difference(tropical_result, network_result)
+
+
+def get_verification_sample(data_batch, logits, no_points=2 ** 6):
+    # Evenly spaced data points of the batch for choose_extraction_precision, with their data and logits.
+    points = np.unique(np.linspace(0, data_batch.shape[0] - 1, min(no_points, data_batch.shape[0])).astype(int))
+    return points, np.asarray(data_batch[points]), np.asarray(logits[points], dtype='float64')
+
+
+def create_shared_directory(prefix):
+    return tempfile.mkdtemp(prefix=prefix, dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+
+class Shared_Array:
+    # Stands in for an array of a shared plan; the workers memory-map the .npy file read-only.
+    def __init__(self, path):
+        self.path = path
+
+
+def share_plan(plan, directory):
+    # Copy of the plan whose arrays are saved to directory and replaced by Shared_Arrays, so pickling it for the
+    # workers does not copy the weights.
+    def share(value):
+        if isinstance(value, np.ndarray):
+            path = os.path.join(directory, str(len(os.listdir(directory))) + '.npy')
+            np.save(path, value)
+            return Shared_Array(path)
+        return value
+
+    shared_plan = copy.copy(plan)
+    for name, value in vars(plan).items():
+        setattr(shared_plan, name, share(value))
+    shared_plan.steps = [{key: share(value) for key, value in step.items()} for step in plan.steps]
+    # Every worker allocates its own buffers.
+    shared_plan.buffers = {}
+    shared_plan.directory = directory
+    return shared_plan
+
+
+def attach_plan(shared_plan):
+    def attach(value):
+        if isinstance(value, Shared_Array):
+            return np.load(value.path, mmap_mode='r')
+        return value
+
+    for name, value in vars(shared_plan).items():
+        setattr(shared_plan, name, attach(value))
+    shared_plan.steps = [{key: attach(value) for key, value in step.items()} for step in shared_plan.steps]
+    return shared_plan
+
+
+def create_process_pool(no_processes, initializer, initargs=()):
+    # Spawns the pool, as forking a process that has initialised TensorFlow is not safe. The processes split the
+    # cores among each other: initializer(no_threads, *initargs) is called in every process.
+    no_threads = max(1, (os.cpu_count() or 1) // no_processes)
+    # The BLAS libraries of the processes read their number of threads from the environment when numpy is
+    # imported, so it is set while the processes are spawned and restored afterwards.
+    thread_variables = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+    previous_values = {name: os.environ.get(name) for name in thread_variables}
+    for name in thread_variables:
+        os.environ[name] = str(no_threads)
+    try:
+        context = multiprocessing.get_context('spawn')
+        return context.Pool(no_processes, initializer=initializer, initargs=(no_threads,) + tuple(initargs))
+    finally:
+        for name, value in previous_values.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+def limit_threads(no_threads):
+    tf.config.threading.set_intra_op_parallelism_threads(no_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+# The plan of the worker process, attached on first use and again whenever a new plan is shared, and its cast to
+# --extraction_precision.
+worker_plan = {'shared_plan': None, 'plan': None, 'single_plan': None}
+
+
+def initialize_worker(no_threads):
+    # The workers run on the CPU.
+    tf.config.set_visible_devices([], 'GPU')
+    limit_threads(no_threads)
+
+
+def extract_batch_in_worker(shared_plan, arg, *args):
+    if worker_plan['shared_plan'] is None or worker_plan['shared_plan'].directory != shared_plan.directory:
+        worker_plan['shared_plan'] = shared_plan
+        worker_plan['plan'] = attach_plan(copy.copy(shared_plan))
+        worker_plan['single_plan'] = get_single_plan(arg, worker_plan['plan'])
+    return extract_batch(arg, worker_plan['plan'], *args, single_plan=worker_plan['single_plan'])
+
+
+class Extraction_Pool:
+    # Process pool that back-propagates batches in parallel once their activation patterns are known. The weights of
+    # the plan are shared read-only through memory-mapped files, in /dev/shm where available. The processes are
+    # reused for all epochs.
+    def __init__(self, no_processes):
+        self.directory = create_shared_directory('tropex_plan_')
+        self.shared_plan = None
+        self.pool = create_process_pool(no_processes, initialize_worker)
+        # The batches are put into finished by the result thread of the pool as they finish, in any order.
+        self.finished = queue.Queue()
+        self.no_pending = 0
+
+    def share(self, plan):
+        # Shares the plan of the next epoch. All batches of the previous plan have to be collected before.
+        if self.shared_plan is not None:
+            shutil.rmtree(self.shared_plan.directory, ignore_errors=True)
+        self.shared_plan = share_plan(plan, tempfile.mkdtemp(dir=self.directory))
+
+    def submit(self, arg, epoch_number, batch_idx, signs, activation_patterns, true_labels, network_labels,
+               linear_regions=None):
+        def finish(result):
+            self.finished.put((batch_idx, result))
+
+        self.no_pending += 1
+        self.pool.apply_async(extract_batch_in_worker, (self.shared_plan, arg, epoch_number, batch_idx, signs,
+                                                        activation_patterns, true_labels, network_labels,
+                                                        linear_regions), callback=finish, error_callback=finish)
+
+    def collect(self, wait=True):
+        # Yields the index, saved shards and densities of the submitted batches in the order they finish, so the
+        # calling process registers them one at a time. Without wait, only the batches that are already finished.
+        while self.no_pending > 0:
+            try:
+                batch_idx, result = self.finished.get(block=wait)
+            except queue.Empty:
+                return
+            self.no_pending -= 1
+            if isinstance(result, BaseException):
+                raise result
+            yield (batch_idx,) + tuple(result)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        shutil.rmtree(self.directory, ignore_errors=True)
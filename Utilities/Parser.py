@@ -11,8 +11,10 @@ def parse_arguments(print_args=True):
                         help='specify which epochs are used')
     parser.add_argument('--data_set', default='MNIST', choices=['MNIST', 'CIFAR10', 'Fashion MNIST'],
                         help='type of architecture used for training (default: CIFAR10)')
-    parser.add_argument('--data_type', default='training', choices=['training', 'test', 'random_hypercube', 'random_100'],
-                        help="use training or test data")
+    parser.add_argument('--data_type', default='training',
+                        choices=['training', 'test', 'random', 'random_hypercube', 'random_100', 'random_1000',
+                                 'random_10000'],
+                        help="use training, test or random data")
     parser.add_argument('--network_type_coarse', default='MNIST', choices=['-', 'AllCNN', 'FCN', 'ResNet', 'VGG', 'MNIST'],
                         help='type of architecture used for training (default: VGG)')
     parser.add_argument('--network_type_fine', default='FCN4',
@@ -29,8 +31,13 @@ def parse_arguments(print_args=True):
                         help="upper index of data points (default: 100)")
     parser.add_argument('--extraction_type', default='neg', choices=['pos_and_neg', 'pos', 'neg', 'linear'],
                         help='type of extraction performed')
+    parser.add_argument('--extraction_precision', default='float64', choices=['float64', 'float32'],
+                        help='precision in which the tropical terms are back-propagated and saved')
 
     # String arguments
+    parser.add_argument('--convolution_backend', default='tensorflow', choices=['tensorflow', 'numpy'],
+                        help='the library that back-propagates the tropical terms through convolutional layers '
+                             '(default: tensorflow)')
     parser.add_argument('--network_number', default='0', choices=['0', '1', '2', '3', '4'],
                         help='number of saved network; the program loops through all numbers if "all" is selected')
     parser.add_argument('--network_number_1', default='1', choices=['0', '1', '2', '3', '4'],
@@ -62,6 +69,11 @@ def parse_arguments(print_args=True):
                         help='level to which the temperature gets reset (default: 100.0)')
     parser.add_argument('--initial_temperature', default=1.0, type=float,
                         help='temperature at the beginning of training (default: 1.0)')
+    parser.add_argument('--recall_target', default=0.99, type=float,
+                        help='agreement with the exact search the approximate search is calibrated to (default: 0.99)')
+    parser.add_argument('--precision_tolerance', default=1e-3, type=float,
+                        help='maximal error of a float32 extraction before the epoch is extracted in float64 '
+                             '(default: 1e-3)')
 
     # Integer Arguments
     parser.add_argument('--batch_size', default=64, type=int,
@@ -70,12 +82,25 @@ def parse_arguments(print_args=True):
                         help='the number of bins for computing the ECE')
     parser.add_argument('--no_epochs', default=200, type=int,
                         help='the number of training epochs')
+    parser.add_argument('--no_processes', default=1, type=int,
+                        help='the number of processes that back-propagate batches in parallel during the extraction')
+    parser.add_argument('--random_seed', default=0, type=int,
+                        help='the seed of the random data types')
+    parser.add_argument('--no_random_points', default=10 ** 4, type=int,
+                        help='the number of data points of the random data types')
+    parser.add_argument('--no_epoch_processes', default=1, type=int,
+                        help='the number of processes that work on different epochs in parallel')
 
     # Tropical Arguments
     parser.add_argument('--extract_all_dimensions', dest='extract_all_dimensions', action='store_true',
                         help="if True: extract the linear functions corresponding to all dimensions")
     parser.add_argument('--save_intermediate', dest='save_intermediate', action='store_true',
                         help="saving all intermediate tropical functions")
+    parser.add_argument('--approximate_search', dest='approximate_search', action='store_true',
+                        help="classify with a cached approximate maximum inner product search index")
+    parser.add_argument('--track_linear_regions', dest='track_linear_regions', action='store_true',
+                        help="save the activation patterns and report the fraction of data points whose linear region "
+                             "changed since the previous epoch")
 
     # Experiment Argument
     parser.add_argument('--mode', default='exp9_compute_coefficient_statistics',
@@ -135,11 +160,16 @@ def parse_arguments(print_args=True):
         print('Maximum Temperature: ' + str(arg.maximum_temperature))
         print('Reset Temperature: ' + str(arg.reset_temperature))
         print('Initial Temperature: ' + str(arg.initial_temperature))
+        print('Precision Tolerance: ' + str(arg.precision_tolerance))
         print('\n')
         print(start_bold + 'Integer Arguments' + end_bold)
         print('Batch Size: ' + str(arg.batch_size))
         print('Number of Bins: ' + str(arg.no_bins))
         print('Number of Training Epochs: ' + str(arg.no_epochs))
+        print('Number of Processes: ' + str(arg.no_processes))
+        print('Number of Epoch Processes: ' + str(arg.no_epoch_processes))
+        print('Random Seed: ' + str(arg.random_seed))
+        print('Number of Random Points: ' + str(arg.no_random_points))
         print('\n')
 
     return arg
@@ -0,0 +1,98 @@
+import hashlib
+import numpy as np
+import os
+from tensorflow.keras.models import Model
+from Utilities.Saver import get_main_directory, open_atomically
+from Utilities.Tropical_Evaluation import iterate_term_blocks
+
+
+def compute_data_hash(data):
+    data = np.ascontiguousarray(data)
+    data_hash = hashlib.blake2b(digest_size=16)
+    data_hash.update(str((data.dtype.str, data.shape)).encode())
+    data_hash.update(data.data)
+    return data_hash.hexdigest()
+
+
+class Prediction_Cache:
+    # Content-addressed cache of the outputs of networks on data. An entry is keyed by the hash of the model file, the
+    # hash of the data and the requested layers, so it stays valid as long as neither changes. The entries are .npz
+    # files in directory; once they take more than max_bytes, the least recently used ones are removed.
+    def __init__(self, directory, max_bytes=2 ** 33):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, model_hash, data, layer_indices):
+        key = '_'.join([model_hash, compute_data_hash(data)] + [str(layer_idx) for layer_idx in layer_indices])
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, path):
+        try:
+            with np.load(path) as entry:
+                outputs = {name: entry[name] for name in entry.files}
+            # The modification time marks the last use.
+            os.utime(path)
+            return outputs
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+    def store(self, path, outputs):
+        with open_atomically(path) as entry_file:
+            np.savez(entry_file, **outputs)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith('.npz') and not file_name.startswith('.'):
+                try:
+                    status = os.stat(os.path.join(self.directory, file_name))
+                except FileNotFoundError:
+                    continue
+                entries.append((status.st_mtime, status.st_size, file_name))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, file_name in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, file_name))
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+
+# Created on first use.
+prediction_cache = {'cache': None}
+
+
+def get_prediction_cache():
+    if prediction_cache['cache'] is None:
+        prediction_cache['cache'] = Prediction_Cache(os.path.join(get_main_directory(), 'Prediction_Cache'))
+    return prediction_cache['cache']
+
+
+def predict_network(network, data, layer_indices=()):
+    # Returns {'logits', 'labels', 'layer_<idx>' for idx in layer_indices}: the logits are the outputs of the layer
+    # before the softmax, the labels the argmax of the outputs of the network, like np.argmax(network.predict(data)).
+    # Networks loaded by load_network carry the hash of their file and are cached, all others are evaluated.
+    model_hash = getattr(network, 'file_hash', None)
+    if model_hash is not None:
+        cache = get_prediction_cache()
+        path = cache.get_path(model_hash, data, layer_indices)
+        outputs = cache.load(path)
+        if outputs is not None:
+            return outputs
+
+    predictor = Model(inputs=network.input, outputs=[network.layers[-2].output, network.output] +
+                      [network.layers[layer_idx].output for layer_idx in layer_indices])
+    # Chunk by chunk, so memory-mapped data is never read at once.
+    predictions = [predictor.predict(np.asarray(chunk)) for _, chunk in iterate_term_blocks(data, 2 ** 14)]
+    predictions = [np.concatenate(outputs) for outputs in zip(*predictions)]
+    outputs = {'logits': predictions[0], 'labels': np.argmax(predictions[1], axis=1)}
+    for layer_idx, layer_output in zip(layer_indices, predictions[2:]):
+        outputs['layer_' + str(layer_idx)] = layer_output
+
+    if model_hash is not None:
+        cache.store(path, outputs)
+    return outputs
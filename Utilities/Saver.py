@@ -1,9 +1,12 @@
+import contextlib
 import csv
 import getpass
+import hashlib
 import numpy as np
 import os
 import pickle
 import socket
+import tempfile
 
 
 def get_network_location(arg, epoch_number):
@@ -34,6 +37,32 @@ def get_file_name(arg, ending, epoch_number=None):
     return file_name
 
 
+def compute_file_hash(path, chunk_size=2 ** 24):
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+@contextlib.contextmanager
+def open_atomically(path, mode='wb'):
+    # Writes to a temporary file next to path that replaces path once it is complete, so an interrupted or concurrent
+    # run never sees a partial file.
+    file_descriptor, temporary_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '_',
+                                                       dir=os.path.dirname(path))
+    try:
+        with os.fdopen(file_descriptor, mode) as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
 def create_directory(*args):
     directory = '/'.join(args)
     if not os.path.isdir(directory):
@@ -41,8 +70,12 @@ def create_directory(*args):
     return directory
 
 
+def get_main_directory():
+    return os.path.join('/home', getpass.getuser(), 'tropex')
+
+
 def get_saving_directory(arg):
-    main_directory = os.path.join('/home', getpass.getuser(), 'tropex')
+    main_directory = get_main_directory()
     if arg.temperature_scaling:
         save_dir = create_directory(main_directory, 'Results', arg.network_type_coarse, arg.activation_function)
     else:
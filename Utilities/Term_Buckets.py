@@ -0,0 +1,160 @@
+import numpy as np
+from Utilities.MIPS_Index import assign_to_centroids, compute_k_means
+from Utilities.Tropical_Evaluation import iterate_term_blocks
+
+
+class Term_Buckets:
+    # Exact maximum inner product search over the terms [bias, coefficients] of a tropical function.
+    # With the mean coefficient vector w_mean and an orthonormal basis P of the principal subspace of the centred
+    # coefficients, every coefficient vector splits into w = w_mean + P p + r, and by Cauchy-Schwarz
+    #   bias + w x <= bias + w_mean x + p (P^T x) + |r| |x - P P^T x|.
+    # The terms are grouped into buckets of similar projections p. A bucket is only evaluated for the data points
+    # for which the largest bound of its terms reaches the best value found so far, so the result is the same
+    # argmax as the exhaustive search. The rounding errors of the bounds only widen the pruning, the remaining terms
+    # are compared by their float64 values and exact ties go to the first term like in np.argmax.
+    def __init__(self, mean_coefficients, basis, term_order, bucket_offsets, scored_terms, residual_norms,
+                 captured_energy=1.0, fingerprint=''):
+        self.mean_coefficients = mean_coefficients
+        self.basis = basis
+        self.term_order = term_order
+        self.bucket_offsets = bucket_offsets
+        self.scored_terms = scored_terms
+        self.residual_norms = residual_norms
+        # Fraction of the variance of the coefficients within the subspace, the pruning is only effective if it is
+        # close to 1.
+        self.captured_energy = captured_energy
+        self.fingerprint = fingerprint
+
+    @property
+    def no_buckets(self):
+        return self.bucket_offsets.shape[0] - 1
+
+    @classmethod
+    def build(cls, terms, bucket_size=2 ** 8, residual_energy=1e-4, max_projection_fraction=0.25, no_iterations=5,
+              sample_size=2 ** 13, block_size=2 ** 12, seed=0, fingerprint=''):
+        no_terms, data_size = terms.shape[0], terms.shape[1] - 1
+        mean_coefficients = np.zeros(data_size)
+        for _, block in iterate_term_blocks(terms, block_size):
+            mean_coefficients += np.sum(np.asarray(block[:, 1:], dtype='float64'), axis=0)
+        mean_coefficients /= no_terms
+
+        # The dimension of the subspace is the smallest one that keeps all but residual_energy of the variance of
+        # the coefficients, but computing the projections should cost at most max_projection_fraction of the
+        # exhaustive search.
+        random_state = np.random.RandomState(seed)
+        sample = np.sort(random_state.choice(no_terms, size=min(sample_size, no_terms), replace=False))
+        centred_sample = np.asarray(terms[sample], dtype='float64')[:, 1:] - mean_coefficients
+        _, singular_values, right_vectors = np.linalg.svd(centred_sample, full_matrices=False)
+        energy = np.cumsum(singular_values ** 2)
+        max_dimension = max(1, int(max_projection_fraction * data_size))
+        if energy[-1] > 0:
+            energy = energy / energy[-1]
+        else:
+            energy = np.ones_like(energy)
+        dimension = min(int(np.searchsorted(energy, 1 - residual_energy)) + 1, max_dimension, energy.shape[0])
+        basis = right_vectors[0:dimension].transpose()
+
+        # The bounds only decide which buckets are evaluated, so the biases and projections are kept in float32 with
+        # the bias as first column.
+        scored_terms = np.empty([no_terms, 1 + basis.shape[1]], dtype='float32')
+        residual_norms = np.empty(no_terms)
+        for lower, block in iterate_term_blocks(terms, block_size):
+            block = np.asarray(block, dtype='float64')
+            upper = lower + block.shape[0]
+            centred = block[:, 1:] - mean_coefficients
+            projections = np.dot(centred, basis)
+            scored_terms[lower:upper, 0] = block[:, 0]
+            scored_terms[lower:upper, 1:] = projections
+            residual_norms[lower:upper] = np.linalg.norm(centred - np.dot(projections, basis.transpose()), axis=1)
+
+        no_buckets = max(1, min(no_terms // bucket_size, sample.shape[0]))
+        centroids = compute_k_means(scored_terms[sample, 1:], no_buckets, no_iterations, random_state)
+        assignment = np.concatenate([assign_to_centroids(scored_terms[lower:lower + block_size, 1:], centroids)
+                                     for lower in range(0, no_terms, block_size)])
+        # Stable, so the terms of every bucket stay in ascending order. Empty buckets are dropped.
+        term_order = np.argsort(assignment, kind='stable')
+        bucket_offsets = np.unique(np.searchsorted(assignment[term_order], np.arange(no_buckets + 1)))
+        return cls(mean_coefficients, basis, term_order, bucket_offsets, scored_terms[term_order],
+                   np.maximum.reduceat(residual_norms[term_order], bucket_offsets[:-1]), energy[dimension - 1],
+                   fingerprint)
+
+    def compute_max(self, terms, data, point_block_size=2 ** 10, bound_block_size=2 ** 13):
+        # Input: (data_size, no_data_points)-sized data.
+        # Output: maxima and indices of the maximal terms
+        no_data_points = data.shape[1]
+        running_max = np.full(no_data_points, -np.inf)
+        running_argmax = np.full(no_data_points, -1, dtype=np.int64)
+        for point_lower in range(0, no_data_points, point_block_size):
+            point_slice = slice(point_lower, min(point_lower + point_block_size, no_data_points))
+            running_max[point_slice], running_argmax[point_slice] = \
+                self.compute_block_max(terms, data[:, point_slice].astype('float64'), bound_block_size)
+        return running_max, running_argmax
+
+    def compute_block_max(self, terms, data, bound_block_size):
+        no_data_points = data.shape[1]
+        data_projections = np.dot(self.basis.transpose(), data)
+        data_residual_norms = np.linalg.norm(data - np.dot(self.basis, data_projections), axis=0)
+        mean_values = np.dot(self.mean_coefficients, data)
+        scored_data = np.vstack([np.ones([1, no_data_points]), data_projections]).astype('float32')
+        data_norms = np.linalg.norm(data, axis=0)
+        max_bias = np.max(np.abs(self.scored_terms[:, 0]))
+        max_projection_norm = np.max(np.linalg.norm(self.scored_terms[:, 1:], axis=1))
+        # Rounding errors of the float32 bounds and of the float64 values of the terms.
+        bound_tolerance = 4 * self.scored_terms.shape[1] * np.finfo('float32').eps * \
+            (max_bias + max_projection_norm * np.linalg.norm(data_projections, axis=0))
+        max_coefficient_norm = np.linalg.norm(self.mean_coefficients) + max_projection_norm + \
+            np.max(self.residual_norms)
+        tie_tolerance = 2 * data.shape[0] * np.finfo('float64').eps * (max_bias + data_norms * max_coefficient_norm)
+
+        # With the largest score of the terms of a bucket, score + residual spread bounds the bucket from above and
+        # score - residual spread bounds its maximal term from below.
+        bucket_scores = np.empty([self.no_buckets, no_data_points])
+        first_bucket = 0
+        while first_bucket < self.no_buckets:
+            last_bucket = first_bucket + 1
+            while last_bucket < self.no_buckets and \
+                    self.bucket_offsets[last_bucket + 1] - self.bucket_offsets[first_bucket] <= bound_block_size:
+                last_bucket += 1
+            first_row = self.bucket_offsets[first_bucket]
+            scores = np.dot(self.scored_terms[first_row:self.bucket_offsets[last_bucket]], scored_data)
+            for bucket_idx in range(first_bucket, last_bucket):
+                lower, upper = self.bucket_offsets[bucket_idx:bucket_idx + 2] - first_row
+                np.max(scores[lower:upper], axis=0, out=bucket_scores[bucket_idx])
+            first_bucket = last_bucket
+        bucket_spreads = np.multiply.outer(self.residual_norms, data_residual_norms)
+        bucket_bounds = bucket_scores + bucket_spreads + mean_values + bound_tolerance + tie_tolerance
+        threshold = np.max(bucket_scores - bucket_spreads, axis=0) + mean_values - bound_tolerance
+
+        running_max = np.full(no_data_points, -np.inf)
+        running_argmax = np.full(no_data_points, -1, dtype=np.int64)
+        for bucket_idx in np.argsort(-np.mean(bucket_bounds, axis=1), kind='stable'):
+            points = np.flatnonzero(bucket_bounds[bucket_idx] >= threshold)
+            if points.size == 0:
+                continue
+            members = self.term_order[self.bucket_offsets[bucket_idx]:self.bucket_offsets[bucket_idx + 1]]
+            block = np.asarray(terms[members], dtype='float64')
+            values = np.dot(block[:, 1:], data[:, points]) + block[:, 0:1]
+            # The members are in ascending order, so np.argmax gives the first maximal term of the bucket.
+            bucket_argmax = np.argmax(values, axis=0)
+            bucket_max = values[bucket_argmax, np.arange(points.size)]
+            bucket_argmax = members[bucket_argmax]
+            current_max = running_max[points]
+            better = (bucket_max > current_max) | \
+                ((bucket_max == current_max) & (bucket_argmax < running_argmax[points]))
+            running_max[points[better]] = bucket_max[better]
+            running_argmax[points[better]] = bucket_argmax[better]
+            threshold[points] = np.maximum(threshold[points], running_max[points] - tie_tolerance[points])
+        return running_max, running_argmax
+
+    def save(self, path):
+        np.savez(path, mean_coefficients=self.mean_coefficients, basis=self.basis, term_order=self.term_order,
+                 bucket_offsets=self.bucket_offsets, scored_terms=self.scored_terms,
+                 residual_norms=self.residual_norms, captured_energy=self.captured_energy,
+                 fingerprint=self.fingerprint)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as buckets:
+            return cls(buckets['mean_coefficients'], buckets['basis'], buckets['term_order'],
+                       buckets['bucket_offsets'], buckets['scored_terms'], buckets['residual_norms'],
+                       float(buckets['captured_energy']), str(buckets['fingerprint']))
@@ -0,0 +1,72 @@
+import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+def iterate_term_blocks(terms, block_size):
+    # Works for arrays and for lazily loaded Concatenated_Terms.
+    if hasattr(terms, 'blocks'):
+        for lower, block in terms.blocks(block_size):
+            yield lower, block
+    else:
+        for lower in range(0, terms.shape[0], block_size):
+            yield lower, terms[lower:lower + block_size]
+
+
+def compute_blockwise_max(terms, data, term_labels=None, no_labels=1, term_block_size=2 ** 11,
+                          point_block_size=2 ** 10, no_threads=None, dtype='float64', verify=False):
+    # Input:
+    # (no_terms, 1 + data_size)-sized terms [bias, coefficients], array or Concatenated_Terms
+    # (data_size, no_data_points)-sized array data
+    # (no_terms)-sized term_labels; if given, the maximum is taken separately over the terms of every label
+    # Output:
+    # (no_labels, no_data_points)-sized maxima and indices of the maximal terms, -inf and -1 if a label has no terms
+    # (if verify) maximal difference between the maxima and the maximal terms evaluated in float64
+    #
+    # Blocks of terms are streamed against blocks of data points and only the running maximum is kept, so the
+    # memory does not depend on the number of terms. The blocks of data points are evaluated by a thread pool.
+    # Ties are resolved like np.argmax: the first maximal term wins.
+    no_data_points = data.shape[1]
+    compute_data = data.astype(dtype, copy=False)
+    running_max = np.full([no_labels, no_data_points], -np.inf, dtype=dtype)
+    running_argmax = np.full([no_labels, no_data_points], -1, dtype=np.int64)
+    point_slices = [slice(lower, min(lower + point_block_size, no_data_points))
+                    for lower in range(0, no_data_points, point_block_size)]
+
+    def update(point_slice, lower, block, block_labels):
+        values = np.dot(block[:, 1:], compute_data[:, point_slice]) + block[:, 0:1]
+        for label in range(no_labels):
+            if block_labels is None:
+                label_values = values
+                label_indices = np.arange(block.shape[0])
+            else:
+                label_indices = np.flatnonzero(block_labels == label)
+                if label_indices.size == 0:
+                    continue
+                label_values = values[label_indices]
+            block_argmax = np.argmax(label_values, axis=0)
+            block_max = label_values[block_argmax, np.arange(label_values.shape[1])]
+            current_max = running_max[label, point_slice]
+            current_argmax = running_argmax[label, point_slice]
+            better = block_max > current_max
+            current_max[better] = block_max[better]
+            current_argmax[better] = lower + label_indices[block_argmax[better]]
+
+    if no_threads is None:
+        no_threads = os.cpu_count()
+    with ThreadPoolExecutor(max_workers=no_threads) as pool:
+        for lower, block in iterate_term_blocks(terms, term_block_size):
+            block = np.asarray(block, dtype=dtype)
+            block_labels = None if term_labels is None else term_labels[lower:lower + block.shape[0]]
+            list(pool.map(lambda point_slice: update(point_slice, lower, block, block_labels), point_slices))
+
+    if not verify:
+        return running_max, running_argmax
+    max_error = 0.0
+    for label in range(no_labels):
+        found = running_argmax[label] >= 0
+        winners = np.asarray(terms[running_argmax[label][found]], dtype='float64')
+        exact_max = np.einsum('ij,ji->i', winners[:, 1:], data[:, found].astype('float64')) + winners[:, 0]
+        if exact_max.size > 0:
+            max_error = max(max_error, float(np.max(np.abs(exact_max - running_max[label][found]))))
+    return running_max, running_argmax, max_error
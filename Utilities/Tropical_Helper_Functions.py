@@ -1,11 +1,23 @@
-import nvidia_smi  # can be installed via 'pip install nvidia-ml-py3'
+import json
 import numpy as np
 import os
+import re
 from tensorflow.keras import backend as K
 from tensorflow.keras.models import Model
+from Utilities.Activation_Patterns import Activation_Patterns
+from Utilities.Concatenated_Terms import Concatenated_Terms
 from Utilities.Custom_Settings import configure_gpu
 from Utilities.Data_Loader import load_data
-from Utilities.Saver import create_directory, get_saving_directory
+from Utilities.MIPS_Index import MIPS_Index
+from Utilities.Prediction_Cache import predict_network
+from Utilities.Saver import compute_file_hash, create_directory, get_saving_directory, open_atomically
+from Utilities.Term_Buckets import Term_Buckets
+from Utilities.Tropical_Evaluation import compute_blockwise_max, iterate_term_blocks
+try:
+    import nvidia_smi  # can be installed via 'pip install nvidia-ml-py3'
+except ImportError:
+    # Without nvidia_smi, the batches are only fitted into the memory of the host.
+    nvidia_smi = None
 
 # To raise an exception on runtime warnings, used for debugging.
 np.seterr(all='raise')
@@ -23,38 +35,29 @@ def evaluate_batch_of_tropical_function(data, pos_terms, neg_terms=None):
     return pos_result
 
 
-def evaluate_tropical_function(data, labels, pos_terms, neg_terms=None):
+def evaluate_tropical_function(data, labels, pos_terms, neg_terms=None, dtype='float64'):
     # Input:
     # (data_size, no_data_points)-sized array data
-    # (no_labels)-sized lists pos_terms, neg_terms
+    # (no_terms)-sized labels of the terms
+    # (no_terms, 1 + data_size)-sized pos_terms, neg_terms, arrays or Concatenated_Terms
     # Output:
     # (no_labels, no_data_points)-sized array
 
     def compute_result(terms):
-        result = [-np.ones(no_data_points)] * no_labels
-        for label in range(no_labels):
-            current_terms = terms[labels == label]
-            if len(current_terms) > 0:
-                result[label] = np.max(np.dot(current_terms[:, 1:], data) + current_terms[:, 0:1], axis=0)
+        result, _ = compute_blockwise_max(terms, data, term_labels=labels, no_labels=no_labels, dtype=dtype)
+        result[np.isneginf(result)] = -1
         return result
 
     no_labels = int(np.max(labels) + 1)
-    no_data_points = data.shape[1]
     pos_result = compute_result(pos_terms)
     if neg_terms is not None:
         neg_result = compute_result(neg_terms)
-        return np.vstack(pos_result), np.vstack(neg_result)
-    return np.vstack(pos_result)
+        return pos_result, neg_result
+    return pos_result
 
 
 def evaluate_network_on_subgrouped_data(network, data_batches):
-    output_predictor = K.function([network.layers[0].input],
-                                  [network.layers[-2].output])
-    x_train_predicted = []
-    for data_batch in data_batches:
-        x_train_predicted.append(np.max(output_predictor([data_batch])[0], axis=1))
-    x_train_predicted = np.hstack(x_train_predicted)
-    return x_train_predicted
+    return np.max(predict_network(network, np.concatenate(data_batches))['logits'], axis=1)
 
 
 def get_current_data(grouped_data, layer_idx, network=None, no_data_groups=None):
@@ -71,18 +74,76 @@ def get_current_data(grouped_data, layer_idx, network=None, no_data_groups=None)
     return prepare_data_for_tropical_function(current_data)
 
 
-def get_max_data_group_size():
-    nvidia_smi.nvmlInit()
-    handle = nvidia_smi.nvmlDeviceGetHandleByIndex(0)
-    info = nvidia_smi.nvmlDeviceGetMemoryInfo(handle)
-    total_memory = info.total
-    if total_memory >= 12 * (10 ** 9):
-        return 2 ** 12
-    elif total_memory >= 6 * (10 ** 9):
-        return 2 ** 11
-    else:
-        os.environ["CUDA_VISIBLE_DEVICES"] = ""
-        return 2 ** 12
+def get_gpu_memory():
+    # Total memory of the first GPU, None without a GPU or without nvidia_smi.
+    if nvidia_smi is None or os.environ.get('CUDA_VISIBLE_DEVICES') == '':
+        return None
+    try:
+        nvidia_smi.nvmlInit()
+        handle = nvidia_smi.nvmlDeviceGetHandleByIndex(0)
+        return nvidia_smi.nvmlDeviceGetMemoryInfo(handle).total
+    except nvidia_smi.NVMLError:
+        return None
+
+
+def get_host_memory():
+    return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def estimate_bytes_per_data_point(network):
+    # Upper bound of the memory the extraction needs per data point of a batch. Every data point adds at most one
+    # float64 row of B, as the signs are back-propagated one after the other, and merging a layer holds B before and
+    # after the layer plus the constant term K, so the widest layer dominates. Networks with branches hold two copies
+    # of B and their sum. The activations of all layers are predicted at once in float32 to get the activation
+    # patterns.
+    # A max pooling layer scatters B with an int64 index per window into its float64 padded input, which is cast
+    # back to the dtype of B. Its activation pattern is the uint8 position of the maximum of every window, found in
+    # the stacked windows of the padded input.
+    def get_size(shape):
+        return int(np.prod(shape[1:]))
+
+    max_row_size = 0
+    activation_size = 0
+    max_pooling_size = 0
+    pattern_bytes = 0
+    for layer in network.layers[0:-1]:
+        output_size = get_size(layer.output_shape)
+        input_size = output_size if get_layer_type(layer) == 'add' else get_size(layer.input_shape)
+        max_row_size = max(max_row_size, output_size + 2 * input_size)
+        activation_size += output_size
+        if get_layer_type(layer) == 'max':
+            padded_size = int(np.prod(get_pooling_padding(layer)[1])) * layer.input_shape[3]
+            max_row_size = max(max_row_size, 2 * output_size + 2 * padded_size)
+            max_pooling_size = max(max_pooling_size, padded_size + (int(np.prod(layer.pool_size)) + 2) * output_size)
+            pattern_bytes += output_size
+    no_copies = 3 if any(get_layer_type(layer) == 'add' for layer in network.layers) else 1
+    return 8 * no_copies * max_row_size + 4 * (activation_size + max_pooling_size) + pattern_bytes
+
+
+def get_max_no_data_points(arg, network, memory_fraction=0.5):
+    # The number of data points whose extraction fits into memory_fraction of the memory. The total memory is used
+    # instead of the free memory, so the batches stay the same between runs and an interrupted extraction can resume.
+    memory = get_host_memory()
+    gpu_memory = get_gpu_memory()
+    if gpu_memory is not None:
+        memory = min(memory, gpu_memory)
+    return memory_fraction * memory / estimate_bytes_per_data_point(network)
+
+
+def get_max_data_group_size(arg, network, memory_fraction=0.5, max_data_group_size=2 ** 12):
+    # The largest power of two of data points whose batch fits into memory_fraction of the memory. It does not depend
+    # on the number of processes, so a restart with another number of processes keeps the batches and their shards.
+    no_data_points = get_max_no_data_points(arg, network, memory_fraction)
+    if no_data_points < 1:
+        return 1
+    return int(min(2 ** int(np.floor(np.log2(no_data_points))), max_data_group_size))
+
+
+def get_max_parallel_batches(arg, network, memory_fraction=0.5):
+    # The number of batches that fit into memory_fraction of the memory at the same time, which bounds the number
+    # of processes that extract batches in parallel.
+    data_group_size = get_max_data_group_size(arg, network, memory_fraction)
+    return max(1, int(get_max_no_data_points(arg, network, memory_fraction) // data_group_size))
 
 
 def get_last_layer_index(network):
@@ -141,16 +202,24 @@ def make_batches(points, max_data_group_size):
     return batches
 
 
-def get_batch_data(arg, network, data_type=None):
+def get_data_points(arg, data_type=None):
     if data_type is None:
         data_type = arg.data_type
     data, true_labels = load_data(arg, data_type)
     if arg.data_type == 'training' and arg.data_set == 'CIFAR10':
         data = data[arg.data_points_lower:arg.data_points_upper]
         true_labels = true_labels[arg.data_points_lower:arg.data_points_upper]
+    return data, true_labels
+
 
-    network_labels = np.argmax(network.predict(data), axis=1)
-    max_data_group_size = get_max_data_group_size()
+def get_batch_data(arg, network, data_type=None, data_points=None):
+    # data_points: (data, true_labels) as returned by get_data_points, to load the data set only once for all epochs.
+    if data_points is None:
+        data_points = get_data_points(arg, data_type)
+    data, true_labels = data_points
+
+    network_labels = predict_network(network, data)['labels']
+    max_data_group_size = get_max_data_group_size(arg, network)
     data_batches = make_batches(data, max_data_group_size)
     true_labels = make_batches(true_labels, max_data_group_size)
     network_labels = make_batches(network_labels, max_data_group_size)
@@ -165,17 +234,66 @@ def stack_list_with_subgroups(terms):
     return np.concatenate(stacked_list)
 
 
-def get_max_indices(terms, test_data):
+def get_max_indices(terms, test_data, dtype='float64', term_buckets=None, min_captured_energy=0.9):
+    # With term_buckets of the terms, e.g. from get_term_buckets, the exact search skips buckets of terms that cannot
+    # contain the maximum if the coefficients mostly lie in a low dimensional subspace. Building the buckets only
+    # pays off if they are reused, so without them all terms are evaluated.
+    if dtype != 'float64' or (term_buckets is not None and term_buckets.captured_energy < min_captured_energy):
+        term_buckets = None
     no_batches = len(test_data)
     indices = [None] * no_batches
     for batch_idx in range(no_batches):
         test_data_batch = prepare_data_for_tropical_function(test_data[batch_idx])
-        indices[batch_idx] = np.argmax(np.dot(terms[:, 1:], test_data_batch) + terms[:, 0:1], axis=0)
+        if term_buckets is None:
+            indices[batch_idx] = compute_blockwise_max(terms, test_data_batch, dtype=dtype)[1][0]
+        else:
+            indices[batch_idx] = term_buckets.compute_max(terms, test_data_batch)[1]
     return np.concatenate(indices)
 
 
-def get_tropical_test_labels(terms, labels, test_data):
-    return labels[get_max_indices(terms, test_data)]
+def get_tropical_test_labels(terms, labels, test_data, mips_index=None, term_buckets=None):
+    if mips_index is None:
+        return labels[get_max_indices(terms, test_data, term_buckets=term_buckets)]
+    indices = [mips_index.search(terms, prepare_data_for_tropical_function(batch)) for batch in test_data]
+    return labels[np.concatenate(indices)]
+
+
+def get_shard_fingerprint(save_dir, sign):
+    # Changes whenever a shard of the function is added, removed or rewritten.
+    return json.dumps([(os.path.basename(path), os.path.getsize(path), os.path.getmtime(path))
+                       for path in get_tropical_shard_paths(save_dir, sign)])
+
+
+def get_mips_index(arg, folder_name, epoch_number, terms, calibration_data, sign='pos'):
+    # The index is cached next to the shards of the training function and rebuilt when the shards change.
+    save_dir = get_tropical_function_directory(arg, folder_name, 'training', epoch_number)
+    index_path = os.path.join(save_dir, 'mips_index_' + sign + '.npz')
+    fingerprint = get_shard_fingerprint(save_dir, sign)
+    if os.path.isfile(index_path):
+        mips_index = MIPS_Index.load(index_path)
+        if mips_index.fingerprint == fingerprint:
+            if mips_index.recall is None or mips_index.recall < arg.recall_target:
+                mips_index.calibrate(terms, calibration_data, arg.recall_target)
+                mips_index.save(index_path)
+            return mips_index
+    mips_index = MIPS_Index.build(terms, fingerprint=fingerprint)
+    mips_index.calibrate(terms, calibration_data, arg.recall_target)
+    mips_index.save(index_path)
+    return mips_index
+
+
+def get_term_buckets(arg, folder_name, epoch_number, terms, sign='pos'):
+    # Like the index of the approximate search, the buckets are cached next to the shards of the training function.
+    save_dir = get_tropical_function_directory(arg, folder_name, 'training', epoch_number)
+    buckets_path = os.path.join(save_dir, 'term_buckets_' + sign + '.npz')
+    fingerprint = get_shard_fingerprint(save_dir, sign)
+    if os.path.isfile(buckets_path):
+        term_buckets = Term_Buckets.load(buckets_path)
+        if term_buckets.fingerprint == fingerprint:
+            return term_buckets
+    term_buckets = Term_Buckets.build(terms, fingerprint=fingerprint)
+    term_buckets.save(buckets_path)
+    return term_buckets
 
 
 def load_tropical_function_batch(save_dir, batch_idx, load_negative=False):
@@ -190,6 +308,10 @@ def get_tropical_filename_ending(batch_idx):
     return '_batch_{}.npy'.format(batch_idx)
 
 
+def get_activation_patterns_path(save_dir, batch_idx):
+    return os.path.join(save_dir, 'activation_patterns_batch_{}.npz'.format(batch_idx))
+
+
 def get_no_subgroups(list_of_file_names, data_group_number):
     return len(list(filter(lambda file_name: 'pos_label_' + str(data_group_number) in file_name, list_of_file_names)))
 
@@ -198,22 +320,111 @@ def get_folder_name(network, index):
     return '_'.join([str(index), network.layers[index].name])
 
 
-def load_tropical_function(arg, folder_name, data_type, epoch_number, sign='pos'):
+def get_manifest_path(save_dir):
+    return os.path.join(save_dir, 'manifest.json')
+
+
+def load_manifest(save_dir):
+    # The manifest lists the finished shards of the tropical functions in save_dir:
+    # manifest['shards'][sign][batch_idx] = {'file', 'no_rows', 'shape', 'checksum'}, and the settings of the
+    # extraction that saved them, see get_extraction_settings.
+    manifest_path = get_manifest_path(save_dir)
+    if not os.path.isfile(manifest_path):
+        return {'shards': {}}
+    with open(manifest_path, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(save_dir, manifest):
+    with open_atomically(get_manifest_path(save_dir), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+
+
+def get_tropical_shard_record(save_dir, sign, batch_idx):
+    # Computed by the process that saved the shard.
+    file_name = sign + get_tropical_filename_ending(batch_idx)
+    path = os.path.join(save_dir, file_name)
+    return {'file': file_name, 'shape': list(np.load(path, mmap_mode='r').shape), 'checksum': compute_file_hash(path)}
+
+
+def get_extraction_settings(arg, network, no_batches):
+    # Shards are only reused by an extraction with the same batches, network file and precision.
+    return {'no_batches': int(no_batches), 'network_hash': getattr(network, 'file_hash', None),
+            'extraction_precision': arg.extraction_precision}
+
+
+def has_extraction_settings(manifest, extraction_settings):
+    return all(manifest.get(key) == value for key, value in extraction_settings.items())
+
+
+def register_tropical_shard(save_dir, sign, batch_idx, record, extraction_settings):
+    record = dict(record, no_rows=record['shape'][0])
+    manifest = load_manifest(save_dir)
+    if not has_extraction_settings(manifest, extraction_settings):
+        # The shards of an extraction with different batches, another network or another precision.
+        manifest = dict(extraction_settings, shards={})
+    manifest['shards'].setdefault(sign, {})[str(batch_idx)] = record
+    save_manifest(save_dir, manifest)
+
+
+def is_tropical_shard_intact(save_dir, record, verify_checksum=True):
+    path = os.path.join(save_dir, record['file'])
+    if not os.path.isfile(path):
+        return False
+    try:
+        shape = list(np.load(path, mmap_mode='r').shape)
+    except ValueError:
+        # Truncated file.
+        return False
+    return shape == record['shape'] and (not verify_checksum or compute_file_hash(path) == record['checksum'])
+
+
+def is_tropical_batch_complete(save_dir, signs, batch_idx, extraction_settings, verify_checksum=True):
+    # True if the shards of the batch are registered for every sign by an extraction with extraction_settings and
+    # unchanged since, e.g. by an interrupted run.
+    manifest = load_manifest(save_dir)
+    if not has_extraction_settings(manifest, extraction_settings):
+        return False
+    records = [manifest['shards'].get(sign, {}).get(str(batch_idx)) for sign in signs]
+    return all(record is not None and is_tropical_shard_intact(save_dir, record, verify_checksum) for record in records)
+
+
+def get_tropical_shard_paths(save_dir, sign, allow_partial=False):
+    manifest = load_manifest(save_dir)
+    if sign in manifest['shards']:
+        shards = manifest['shards'][sign]
+        batch_indices = sorted(map(int, shards.keys()))
+        no_batches = manifest.get('no_batches')
+        if not allow_partial and no_batches is not None and batch_indices != list(range(no_batches)):
+            raise Exception('The tropical function in ' + save_dir + ' is incomplete: ' + str(len(batch_indices)) +
+                            ' of ' + str(no_batches) + ' batches of ' + sign + ' were extracted.')
+        paths = []
+        for batch_idx in batch_indices:
+            record = shards[str(batch_idx)]
+            if not is_tropical_shard_intact(save_dir, record, verify_checksum=False):
+                if not allow_partial:
+                    raise Exception('The shard ' + record['file'] + ' in ' + save_dir + ' is missing or damaged.')
+                continue
+            paths.append(os.path.join(save_dir, record['file']))
+        return paths
+    # Functions extracted before the manifest was introduced.
+    pattern = re.compile('^' + re.escape(sign) + r'_batch_(\d+)\.npy$')
+    batch_indices = sorted(int(match.group(1)) for match in map(pattern.match, os.listdir(save_dir)) if match)
+    return [os.path.join(save_dir, sign + get_tropical_filename_ending(batch_idx)) for batch_idx in batch_indices]
+
+
+def load_tropical_function(arg, folder_name, data_type, epoch_number, sign='pos', lazy=False, allow_partial=False):
+    # If lazy, the terms are a Concatenated_Terms view of the memory-mapped shards instead of an array in memory.
+    # Functions of interrupted extractions raise an exception unless allow_partial, then the finished shards are loaded.
     save_dir = get_tropical_function_directory(arg, folder_name, data_type, epoch_number)
-    no_batches = max(map(lambda x: int(''.join(filter(str.isdigit, x))), os.listdir(save_dir))) + 1
-    terms = [None] * no_batches
-    for batch_idx in range(no_batches):
-        file_name_ending = get_tropical_filename_ending(batch_idx)
-        path = os.path.join(save_dir, sign + file_name_ending)
-        if not os.path.isfile(path):
-            continue
-        else:
-            terms[batch_idx] = np.load(path)
-    terms = np.vstack(list(filter(None.__ne__, terms)))
+    shards = [np.load(path, mmap_mode='r') for path in get_tropical_shard_paths(save_dir, sign, allow_partial)]
+    terms = Concatenated_Terms(shards)
     true_labels = terms[:, 0]
     network_labels = terms[:, 1]
-    return terms[:, 2:], true_labels, network_labels
-    
+    if lazy:
+        return terms[:, 2:], true_labels, network_labels
+    return np.asarray(terms[:, 2:]), true_labels, network_labels
+
 
 def predict_data(network, data_batch, flag, layer_idx):
     # predictor = K.function([network.layers[0].input],
@@ -248,73 +459,80 @@ def get_layer_type(layer):
     return layer.name.split('_')[0]
 
 
+def get_pooling_padding(layer):
+    # Padding of a max pooling layer at the top and left, and the height and width of its padded input.
+    input_height, input_width = layer.input_shape[1:3]
+    output_height, output_width = layer.output_shape[1:3]
+    pool_height, pool_width = layer.pool_size
+    stride_height, stride_width = layer.strides
+    padded_height = max((output_height - 1) * stride_height + pool_height, input_height)
+    padded_width = max((output_width - 1) * stride_width + pool_width, input_width)
+    if layer.padding == 'same':
+        padding = ((padded_height - input_height) // 2, (padded_width - input_width) // 2)
+    else:
+        padding = (0, 0)
+    return padding, (padded_height, padded_width)
+
+
+def compute_max_pooling_pattern(layer, data_before_layer):
+    # Activation pattern of a max pooling layer for any pool size, strides and padding, of shape
+    # (no_points, output_height, output_width, channels): the position of the maximum within every window, row by row
+    # in the window. Ties go to the first position.
+    (pad_top, pad_left), padded_shape = get_pooling_padding(layer)
+    no_points, input_height, input_width, channels = data_before_layer.shape
+    output_height, output_width = layer.output_shape[1:3]
+    pool_height, pool_width = layer.pool_size
+    stride_height, stride_width = layer.strides
+    padded_data = np.full((no_points,) + padded_shape + (channels,), np.NINF, dtype=data_before_layer.dtype)
+    padded_data[:, pad_top:pad_top + input_height, pad_left:pad_left + input_width, :] = data_before_layer
+    windows = np.stack([padded_data[:, i:i + (output_height - 1) * stride_height + 1:stride_height,
+                                    j:j + (output_width - 1) * stride_width + 1:stride_width, :]
+                        for i in range(pool_height) for j in range(pool_width)], axis=-1)
+    return np.argmax(windows, axis=-1).astype(np.min_scalar_type(pool_height * pool_width - 1))
+
+
 def get_activation_patterns(arg, network, batch=None):
-    # activation_patterns = no_data_groups x no_data_subgroups x no_relevant_layers
+    # Returns the bit-packed activation patterns of the batch, last relevant layer first.
     def turn_data_into_activation_patterns(data):
-        current_activation_patterns = []
+        current_activation_patterns = Activation_Patterns()
         for layer in reversed(layers_without_softmax):
             layer_type = get_layer_type(layer)
             if layer_type in ['leaky', 're', 'activation']:
                 data_after_layer = data.pop()
                 current_activation_patterns.append(data_after_layer <= 0)
             elif layer_type == 'max':
-                data_after_layer = data.pop()
+                data.pop()
                 data_before_layer = data.pop()
-                repeated_data = np.repeat(np.repeat(data_after_layer, repeats=2, axis=1), repeats=2, axis=2)
-
-                def pad_data_before_layer(data_before_layer, repeated_data, axis):
-                    shape = data_before_layer.shape
-                    if repeated_data.shape[axis] == shape[axis] + 1:
-                        new_array = np.full(shape[0:axis] + (1,) + shape[axis+1:], np.NINF)
-                        data_before_layer = np.concatenate([data_before_layer, new_array], axis=axis)
-                        padding = True
-                    else:
-                        padding = False
-                    return data_before_layer, padding
-
-                data_before_layer, vertical_padding = pad_data_before_layer(data_before_layer, repeated_data, 1)
-                data_before_layer, horizontal_padding = pad_data_before_layer(data_before_layer, repeated_data, 2)
-
-                aps = (repeated_data != data_before_layer)
-                # The following guarantees that in each maxpooling square, at least 3 out of 4 elements of B are set to zero.
-                if vertical_padding:
-                    aps[:, -1, :, :] = True
-                if horizontal_padding:
-                    aps[:, :, -1, :] = True
-                aps[:, ::2, 1::2, :] = np.logical_or(aps[:, ::2, 1::2, :], np.logical_not(aps[:, ::2, ::2]))
-                aps[:, 1::2, ::2, :] = np.logical_or(aps[:, 1::2, ::2, :], np.logical_not(aps[:, ::2, ::2]))
-                aps[:, 1::2, ::2, :] = np.logical_or(aps[:, 1::2, ::2, :], np.logical_not(aps[:, ::2, 1::2]))
-                aps[:, 1::2, 1::2, :] = np.logical_or(aps[:, 1::2, 1::2, :], np.logical_not(aps[:, ::2, ::2]))
-                aps[:, 1::2, 1::2, :] = np.logical_or(aps[:, 1::2, 1::2, :], np.logical_not(aps[:, ::2, 1::2]))
-                aps[:, 1::2, 1::2, :] = np.logical_or(aps[:, 1::2, 1::2, :], np.logical_not(aps[:, 1::2, ::2]))
-
-                if vertical_padding:
-                    aps = aps[:, 0:-1, :, :]
-                if horizontal_padding:
-                    aps = aps[:, :, 0:-1, :]
-
-                current_activation_patterns.append(aps)
+                current_activation_patterns.append(compute_max_pooling_pattern(layer, data_before_layer))
         return current_activation_patterns
 
-    input = network.input
-    outputs = []
     layers_without_softmax = network.layers[0:-1]
-    for layer_idx in range(len(layers_without_softmax)):
-        layer = layers_without_softmax[layer_idx]
-        layer_type = get_layer_type(layer)
-        if layer_type in ['leaky', 're', 'activation']:
-            outputs.append(layer.output)
-        elif layer_type == 'max':
-            outputs.append(layers_without_softmax[layer_idx - 1].output)
-            outputs.append(layer.output)
-
-    os.environ["CUDA_VISIBLE_DEVICES"] = arg.gpu
-    predictor = K.function([input], outputs)
-    predicted_data = predictor([batch])
-    activation_patterns = turn_data_into_activation_patterns(predicted_data)
-    K.clear_session()
-    os.environ["CUDA_VISIBLE_DEVICES"] = ""
-    return activation_patterns
+    predicted_data = get_activation_predictor(network).predict_on_batch(batch)
+    if not isinstance(predicted_data, list):
+        predicted_data = [predicted_data]
+    return turn_data_into_activation_patterns(predicted_data)
+
+
+# The multi-output model that predicts the inputs of the activation patterns is built once per network and reused
+# for all batches. Only the predictor of the last network is kept, so earlier networks can be freed.
+activation_predictor_cache = {'network': None, 'predictor': None}
+
+
+def get_activation_predictor(network):
+    if activation_predictor_cache['network'] is not network:
+        outputs = []
+        layers_without_softmax = network.layers[0:-1]
+        for layer_idx in range(len(layers_without_softmax)):
+            layer = layers_without_softmax[layer_idx]
+            layer_type = get_layer_type(layer)
+            if layer_type in ['leaky', 're', 'activation']:
+                outputs.append(layer.output)
+            elif layer_type == 'max':
+                outputs.append(layers_without_softmax[layer_idx - 1].output)
+                outputs.append(layer.output)
+        activation_predictor_cache['network'] = network
+        activation_predictor_cache['predictor'] = Model(inputs=network.input, outputs=outputs)
+    return activation_predictor_cache['predictor']
 
 
 def get_epoch_numbers(arg):
@@ -330,6 +548,15 @@ def get_epoch_numbers(arg):
         return [None]
 
 
+def get_previous_epoch_number(arg, epoch_number):
+    # The epoch before epoch_number in get_epoch_numbers(arg), None for the first one.
+    epoch_numbers = get_epoch_numbers(arg)
+    epoch_idx = epoch_numbers.index(epoch_number)
+    if epoch_idx == 0:
+        return None
+    return epoch_numbers[epoch_idx - 1]
+
+
 def get_associated_training_points(arg, network, x_test, x_train):
     pos_terms = np.vstack(load_tropical_function(arg, network, 'training', None))
     associated_training_points = []
@@ -369,6 +596,30 @@ def flatten_and_stack(true_labels, network_labels, bias, B, batch_idx):
     return result
 
 
+def save_tropical_terms(path, true_labels, network_labels, bias, B, row_index=None, max_chunk_bytes=2 ** 26,
+                        dtype=None):
+    # Writes the rows [true_label, network_label, bias, B] of the data points into a pre-allocated, memory-mapped
+    # .npy file, chunk by chunk. Only max_chunk_bytes of dense terms are held in memory at a time; the rows
+    # B[row_index] of the data points are not materialized at once. The terms are saved in dtype, B.dtype by default.
+    if row_index is None:
+        row_index = np.arange(B.shape[0])
+    if dtype is None:
+        dtype = B.dtype
+    no_rows = row_index.shape[0]
+    no_coefficients = int(np.prod(B.shape[1:]))
+    terms = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(no_rows, 3 + no_coefficients))
+    chunk_size = max(1, max_chunk_bytes // (terms.shape[1] * terms.dtype.itemsize))
+    for lower in range(0, no_rows, chunk_size):
+        upper = min(lower + chunk_size, no_rows)
+        chunk_index = row_index[lower:upper]
+        terms[lower:upper, 0] = true_labels[lower:upper]
+        terms[lower:upper, 1] = network_labels[lower:upper]
+        terms[lower:upper, 2] = bias[chunk_index, 0]
+        terms[lower:upper, 3:] = B[chunk_index].reshape([upper - lower, -1])
+    terms.flush()
+    del terms
+
+
 def prepare_data_for_tropical_function(data):
     return np.reshape(data, newshape=[data.shape[0], -1]).transpose()
 
@@ -377,19 +628,16 @@ def normalize(matrix):
     return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
 
 
-def compute_similarity(terms_0, terms_1,epoch_number):
+def compute_similarity(terms_0, terms_1, epoch_number, block_size=2 ** 12):
+    # Compares the terms row by row and coefficient by coefficient. The terms are read block-wise, so they can be
+    # lazily loaded tropical functions.
     def compute_1_1_angles(A, B):
         A = normalize(A)
         B = normalize(B)
         # clipping because there may be values slightly above 1/below -1
         return np.arccos(np.clip(np.einsum('ij,ij->i', A, B), -1, 1))
 
-    def compute_1_1_correlations(A, B):
-        A -= np.mean(A, axis=0, keepdims=True)
-        B -= np.mean(B, axis=0, keepdims=True)
-        A_B = np.sum(A * B, axis=0)
-        A_A = np.sum(A * A, axis=0)
-        B_B = np.sum(B * B, axis=0)
+    def compute_1_1_correlations(A_B, A_A, B_B):
         divisor = np.sqrt(A_A) * np.sqrt(B_B)
         correlation = np.divide(A_B, divisor, out=np.ones_like(A_B), where=(divisor != 0))
         return correlation
@@ -397,11 +645,29 @@ def compute_similarity(terms_0, terms_1,epoch_number):
     def compute_distances(A, B):
         return np.linalg.norm(A - B, axis=1)
 
-    angles = compute_1_1_angles(terms_0, terms_1)
-    correlations = compute_1_1_correlations(terms_0, terms_1)
+    no_terms = len(terms_0)
+    mean_0 = sum(np.sum(A, axis=0) for _, A in iterate_term_blocks(terms_0, block_size)) / no_terms
+    mean_1 = sum(np.sum(B, axis=0) for _, B in iterate_term_blocks(terms_1, block_size)) / no_terms
+
+    angles = []
+    distances = []
+    A_B, A_A, B_B = 0, 0, 0
+    for lower, A in iterate_term_blocks(terms_0, block_size):
+        # The blocks of Concatenated_Terms follow their shards, so the rows of terms_1 are sliced to match.
+        B = np.asarray(terms_1[lower:lower + A.shape[0]])
+        angles.append(compute_1_1_angles(A, B))
+        A = A - mean_0
+        B = B - mean_1
+        A_B = A_B + np.sum(A * B, axis=0)
+        A_A = A_A + np.sum(A * A, axis=0)
+        B_B = B_B + np.sum(B * B, axis=0)
+        # The distances are computed between the centered terms.
+        distances.append(compute_distances(A, B))
+    angles = np.concatenate(angles)
+    correlations = compute_1_1_correlations(A_B, A_A, B_B)
     if epoch_number == '00':
         correlations[0] = 0
-    distances = compute_distances(terms_0, terms_1)
+    distances = np.concatenate(distances)
     return angles, correlations, distances
 
 